@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 6 Mar 2012
+
+@author: Éric Piel
+
+Copyright © 2012 Éric Piel, Delmic
+
+This file is part of Delmic Acquisition Software.
+
+Delmic Acquisition Software is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version.
+
+Delmic Acquisition Software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
+'''
+import math
+import numpy
+
+class BoxIndex(object):
+    """
+    A spatial index of many boxes (or points), stored in numpy arrays. The
+    boxes are sorted by the cell of a grid which contains their top-left
+    corner, so that the ones in an area are found without checking them all.
+    """
+    # above this number of rows of cells, it's faster to check every box
+    MAX_QUERY_ROWS = 64
+
+    def __init__(self, boxes, cell_size=None):
+        """
+        boxes (numpy array (N, 4) of float): left, top, right, bottom of each
+          box (for points, left == right and top == bottom)
+        cell_size (float>0 or None): size of the cells of the grid (in the
+          same unit as the boxes). If None, it is chosen so that there are
+          about as many cells as boxes.
+        """
+        boxes = numpy.asarray(boxes, dtype=numpy.float64).reshape(-1, 4)
+        if cell_size is None:
+            cell_size = 1.0
+            if len(boxes):
+                extent = max(boxes[:, 2].max() - boxes[:, 0].min(),
+                             boxes[:, 3].max() - boxes[:, 1].min())
+                cell_size = (extent / math.sqrt(len(boxes))) or 1.0
+        self.cell_size = cell_size
+        if len(boxes):
+            # the boxes can go further than their cell: the query is extended
+            self._max_size = (float((boxes[:, 2] - boxes[:, 0]).max()),
+                              float((boxes[:, 3] - boxes[:, 1]).max()))
+        else:
+            self._max_size = (0.0, 0.0)
+        keys = self._GetKeys(numpy.floor(boxes[:, 0] / cell_size),
+                             numpy.floor(boxes[:, 1] / cell_size))
+        # stable, so that the boxes of a cell stay in the original order
+        self._order = numpy.argsort(keys, kind="mergesort")
+        self._keys = keys[self._order]
+        self.boxes = boxes[self._order]
+
+    def __len__(self):
+        return len(self.boxes)
+
+    @staticmethod
+    def _GetKeys(cx, cy):
+        """
+        cx, cy (numpy arrays or float): column and row of the cells
+        returns (numpy array of int64): a number for each cell, sorted by row
+          then by column
+        """
+        cx = numpy.clip(cx, -2**30, 2**30 - 1).astype(numpy.int64)
+        cy = numpy.clip(cy, -2**30, 2**30 - 1).astype(numpy.int64)
+        return (cy << 31) + (cx + 2**30)
+
+    def Query(self, area):
+        """
+        Finds the boxes which intersect an area
+        area (4-tuple float): left, top, right, bottom
+        returns (numpy array of int): the indices of the boxes (in the order of
+          BoxIndex.boxes)
+        """
+        if not len(self.boxes):
+            return numpy.zeros((0,), dtype=numpy.intp)
+        cs = self.cell_size
+        x0 = math.floor((area[0] - self._max_size[0]) / cs)
+        x1 = math.floor(area[2] / cs)
+        y0 = math.floor((area[1] - self._max_size[1]) / cs)
+        y1 = math.floor(area[3] / cs)
+        if y1 - y0 + 1 > self.MAX_QUERY_ROWS:
+            candidates = numpy.arange(len(self.boxes))
+        else:
+            # on each row of cells, the boxes of the columns needed are together
+            rows = numpy.arange(y0, y1 + 1)
+            starts = numpy.searchsorted(self._keys, self._GetKeys(x0, rows), "left")
+            ends = numpy.searchsorted(self._keys, self._GetKeys(x1, rows), "right")
+            candidates = numpy.concatenate([numpy.arange(s, e) for s, e in zip(starts, ends)])
+        b = self.boxes[candidates]
+        inside = ((b[:, 0] <= area[2]) & (b[:, 2] >= area[0]) &
+                  (b[:, 1] <= area[3]) & (b[:, 3] >= area[1]))
+        return candidates[inside]
+
+    def GetOriginalIndices(self, indices):
+        """
+        indices (numpy array of int): indices in BoxIndex.boxes
+        returns (numpy array of int): the indices in the boxes originally given
+        """
+        return self._order[indices]
+
+# vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
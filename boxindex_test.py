@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 6 Mar 2012
+
+@author: Éric Piel
+
+Copyright © 2012 Éric Piel, Delmic
+
+This file is part of Delmic Acquisition Software.
+
+Delmic Acquisition Software is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version.
+
+Delmic Acquisition Software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
+'''
+from boxindex import BoxIndex
+import numpy
+import unittest
+
+class TestBoxIndex(unittest.TestCase):
+
+    def test_Points(self):
+        points = numpy.random.uniform(-1000, 1000, (5000, 2))
+        index = BoxIndex(numpy.hstack([points, points]))
+        self.assertEqual(len(index), 5000)
+        for area in [(-100, -50, 120, 80), (900, 900, 2000, 2000),
+                     (-1e6, -1e6, 1e6, 1e6), (5000, 5000, 6000, 6000)]:
+            found = index.GetOriginalIndices(index.Query(area))
+            expected = numpy.nonzero((points[:, 0] >= area[0]) & (points[:, 0] <= area[2]) &
+                                     (points[:, 1] >= area[1]) & (points[:, 1] <= area[3]))[0]
+            self.assertEqual(sorted(found.tolist()), expected.tolist())
+
+    def test_Boxes(self):
+        # a big box spans many cells, but is indexed in only one
+        boxes = [(0, 0, 1, 1), (10, 10, 11, 11), (-50, -50, 50, 50)]
+        index = BoxIndex(boxes, cell_size=1)
+        found = index.GetOriginalIndices(index.Query((20, 20, 30, 30)))
+        self.assertEqual(found.tolist(), [2])
+        found = index.GetOriginalIndices(index.Query((0.5, 0.5, 10.5, 10.5)))
+        self.assertEqual(sorted(found.tolist()), [0, 1, 2])
+        self.assertEqual(len(index.Query((60, 60, 70, 70))), 0)
+
+    def test_Empty(self):
+        index = BoxIndex(numpy.zeros((0, 4)))
+        self.assertEqual(len(index.Query((0, 0, 10, 10))), 0)
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
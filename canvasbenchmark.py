@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 28 Feb 2012
+
+@author: Éric Piel
+
+Copyright © 2012 Éric Piel, Delmic
+
+This file is part of Delmic Acquisition Software.
+
+Delmic Acquisition Software is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version.
+
+Delmic Acquisition Software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
+'''
+# Benchmark of the rendering of the canvas, with synthetic images of various
+# sizes, at various zooms, merge ratios and while panning. For each scenario,
+# the latency of each frame (time between the change and its display)
+# is reported, as well as the metrics of the canvas and the memory used by the
+# scenario (increase of the memory of the process while it runs).
+# The result can be compared to a previous result (the baseline).
+#
+# It needs a display, but it can be a virtual one, for instance:
+# xvfb-run ./canvasbenchmark.py -o result.json
+# xvfb-run ./canvasbenchmark.py --sizes 512 2048 -b result.json
+
+from dblmscopecanvas import DblMicroscopeCanvas
+from dblmscopeviewmodel import DblMscopeViewModel
+from instrmodel import InstrumentalImage
+import argparse
+import json
+import numpy
+import platform
+import resource
+import sys
+import time
+import wx
+
+SIZES = [512, 2048, 8192, 16384] # px
+SCALES = [1.0 / 16, 1.0 / 4, 1.0, 4.0] # displayed size of the first image
+RATIOS = [0.0, 0.3, 0.7, 1.0]
+PANS = ["arrows", "jumps", "drag"]
+WINDOW_SIZE = (800, 600) # px
+MPP = 1e-7 # m/px of the first image
+TIMEOUT = 60 # s, maximum time to wait for a frame
+# memory increase always accepted compared to the baseline (MiB), as small
+# amounts vary from one run to another
+MEMORY_MARGIN = 10
+
+def loop():
+    """
+    Process all the events pending
+    """
+    app = wx.GetApp()
+    while True:
+        wx.CallAfter(app.ExitMainLoop)
+        app.MainLoop()
+        if not app.Pending():
+            break
+
+def wait_frame(canvas, timeout=TIMEOUT, sampler=None):
+    """
+    Wait until the canvas has displayed all the changes requested
+    sampler (MemorySampler or None): sampled while waiting
+    returns (FrameFuture): the frame displayed
+    """
+    future = canvas.GetFrameFuture()
+    while not future.done():
+        if time.time() - future.start > timeout:
+            raise IOError("Canvas not updated after %g s" % timeout)
+        loop()
+        if sampler:
+            sampler.sample()
+        time.sleep(0.0005)
+    return future
+
+def get_peak_memory():
+    """
+    returns (float): maximum memory used by the process up to now (MiB)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 2.0 ** 20 # in bytes
+    else:
+        return peak / 2.0 ** 10 # in KiB
+
+def get_memory():
+    """
+    returns (float): memory currently used by the process (resident set size,
+      in MiB). If it's not available (not on Linux), the peak memory is
+      returned instead.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 2.0 ** 20
+    except (IOError, IndexError, ValueError):
+        return get_peak_memory()
+
+class MemorySampler(object):
+    """
+    Follows the memory used during a scenario, by sampling it regularly
+    """
+    def __init__(self):
+        self.start = get_memory()
+        self.peak = self.start
+
+    def sample(self):
+        self.peak = max(self.peak, get_memory())
+
+    def get_stats(self):
+        """
+        returns (dict): start, peak, and increase (peak - start) of the memory
+          (MiB)
+        """
+        return {"start": self.start, "peak": self.peak,
+                "increase": self.peak - self.start}
+
+def get_stats(latencies):
+    """
+    latencies (list of float): duration of each frame (s)
+    returns (dict): count, mean, min, max, p50, p90, p99 of the durations (s)
+    """
+    a = numpy.array(latencies)
+    stats = {"count": len(a), "mean": a.mean(), "min": a.min(), "max": a.max()}
+    for p in (50, 90, 99):
+        stats["p%d" % p] = numpy.percentile(a, p)
+    return stats
+
+def make_image(size, seed=0):
+    """
+    Creates a synthetic image with details at every scale (gradients and a
+    checkerboard), so that the rescaling cannot be cheated.
+    size (int): width and height of the image (px)
+    seed (int): changes the pattern
+    returns (numpy array (size, size, 3) of uint8): the RGB image (used
+      directly by InstrumentalImage, without copy)
+    """
+    pos = numpy.arange(size, dtype=numpy.uint32)
+    data = numpy.empty((size, size, 3), dtype=numpy.uint8)
+    data[:, :, 0] = (pos * 256 // size).astype(numpy.uint8)[numpy.newaxis, :]
+    data[:, :, 1] = (pos * 256 // size).astype(numpy.uint8)[:, numpy.newaxis]
+    stripes = ((pos >> (3 + seed)) & 1).astype(numpy.uint8) * 255
+    data[:, :, 2] = stripes[:, numpy.newaxis] ^ stripes[numpy.newaxis, :]
+    return data
+
+class Benchmark(object):
+    """
+    Runs the scenarios on a DblMicroscopeCanvas in a window
+    """
+    def __init__(self, window_size=WINDOW_SIZE):
+        self.app = wx.PySimpleApp()
+        self.frame = wx.Frame(None, title="Canvas benchmark")
+        self.frame.viewmodel = DblMscopeViewModel()
+        self.viewmodel = self.frame.viewmodel
+        self.canvas = DblMicroscopeCanvas(self.frame)
+        self.frame.SetClientSize(window_size)
+        self.frame.Show(True)
+        loop()
+        self.results = {}
+
+    def close(self):
+        self.frame.Destroy()
+        loop()
+
+    def set_images(self, size):
+        """
+        Displays two synthetic images: one of the given size, and one half as
+        big, with more details, on top of it (like the SEM and optical images)
+        """
+        self.clear_images()
+        self.viewmodel.images[0].value = InstrumentalImage(make_image(size, 0),
+                                                           MPP, (0.0, 0.0))
+        half = max(1, size // 2)
+        self.viewmodel.images[1].value = InstrumentalImage(make_image(half, 1),
+                                                           MPP / 2, (MPP * 10, MPP * 10))
+        wait_frame(self.canvas)
+
+    def clear_images(self):
+        for av in self.viewmodel.images:
+            av.value = InstrumentalImage(None, None, None)
+
+    def set_scale(self, scale):
+        """
+        Zooms so that the first image is displayed with the given scale
+        """
+        self.viewmodel.mpp.value = MPP / scale
+
+    def measure(self, name, actions):
+        """
+        Runs a scenario and records its results
+        name (string): name of the scenario
+        actions (list of callable): each of them changes the view, and the
+          resulting frame is measured
+        """
+        canvas = self.canvas
+        latencies = []
+        canvas.metrics.reset()
+        sampler = MemorySampler()
+        for a in actions:
+            start = time.time()
+            a()
+            sampler.sample()
+            frame = wait_frame(canvas, sampler=sampler)
+            latencies.append(frame.end - start)
+        sampler.sample()
+        stats = get_stats(latencies)
+        memory = sampler.get_stats()
+        self.results[name] = {"latency": stats,
+                              "frames": latencies,
+                              "metrics": canvas.metrics.get_all(),
+                              "memory": memory}
+        print "%s: p50 = %.1f ms, p90 = %.1f ms, memory +%.1f MiB" % (
+                    name, stats["p50"] * 1000, stats["p90"] * 1000, memory["increase"])
+
+    def run_size(self, size, scales=SCALES, ratios=RATIOS, pans=PANS):
+        """
+        Runs all the scenarios for the images of a given size
+        """
+        self.set_images(size)
+        canvas = self.canvas
+        # same position for every size
+        canvas.ReCenterBuffer((0, 0))
+
+        # zooms: from the default zoom, and back
+        actions = []
+        for s in scales:
+            actions.append(lambda s=s: self.set_scale(s))
+            actions.append(lambda: self.set_scale(1))
+        self.measure("%d/zoom" % size, actions)
+
+        # merge ratio, at the various zooms (ie, the whole buffer is recomputed)
+        for s in scales:
+            self.set_scale(s)
+            wait_frame(canvas)
+            actions = [lambda r=r: setattr(self.viewmodel.merge_ratio, "value", r)
+                       for r in ratios]
+            self.measure("%d/ratio/x%g" % (size, s), actions)
+
+        # pans, at the various zooms
+        for s in scales:
+            self.set_scale(s)
+            wait_frame(canvas)
+            for p in pans:
+                self.measure("%d/%s/x%g" % (size, p, s), self.get_pan_actions(p))
+
+        self.set_scale(1)
+        self.clear_images()
+
+    def get_pan_actions(self, pattern):
+        """
+        returns (list of callable): the moves of a pan pattern
+        pattern (string): "arrows" (small moves, as with the keyboard), "jumps"
+          (moves of more than the window size), or "drag" (the view follows
+          the mouse, and the buffer is recentred at the end)
+        """
+        canvas = self.canvas
+        if pattern == "arrows":
+            return [lambda: canvas.ShiftView((16, 0))] * 10 + [lambda: canvas.ShiftView((0, -16))] * 10
+        elif pattern == "jumps":
+            jump = WINDOW_SIZE[0] + 100
+            return [lambda d=d: canvas.ShiftView((d, d)) for d in [jump, -jump] * 5]
+        elif pattern == "drag":
+            def drag(shift):
+                # like OnMouseMotion
+                canvas.dragging = True
+                canvas.drag_shift = shift
+                canvas.Refresh()
+            def release():
+                canvas.dragging = False
+                canvas.ReCenterBufferAroundView()
+            actions = [lambda i=i: drag((i * 8, i * 4)) for i in range(1, 31)]
+            actions.append(release)
+            return actions
+        else:
+            raise ValueError("Unknown pan pattern %s" % pattern)
+
+    def get_report(self):
+        """
+        returns (dict): all the results, and the conditions of the benchmark
+        """
+        return {"info": {"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                         "platform": platform.platform(),
+                         "python": platform.python_version(),
+                         "wx": wx.version(),
+                         "numpy": numpy.version.version,
+                         "window_size": WINDOW_SIZE},
+                "results": self.results}
+
+def compare(report, baseline, tolerance, memory_tolerance):
+    """
+    Compares the latencies and memory usage of two reports
+    report (dict): the current results
+    baseline (dict): the reference results
+    tolerance (float): relative increase of latency accepted
+    memory_tolerance (float): relative increase of memory usage accepted (in
+      addition to MEMORY_MARGIN)
+    returns (list of string): the scenarios slower or using more memory than
+      the baseline
+    """
+    regressions = []
+    for name in sorted(report["results"]):
+        if name not in baseline["results"]:
+            continue
+        cur = report["results"][name]
+        ref = baseline["results"][name]
+        ratios = []
+        for p in ("p50", "p90"):
+            if cur["latency"][p] and ref["latency"][p]:
+                ratios.append(cur["latency"][p] / ref["latency"][p])
+        status = ""
+        if ratios:
+            worst = max(ratios)
+            status += " %.2fx" % worst
+            if worst > 1 + tolerance:
+                status += " <= slower"
+        
+        # (older reports have no memory per scenario)
+        if "memory" in cur and "memory" in ref:
+            cur_mem = cur["memory"]["increase"]
+            ref_mem = ref["memory"]["increase"]
+            status += ", memory +%.1f MiB (baseline +%.1f MiB)" % (cur_mem, ref_mem)
+            if cur_mem > ref_mem * (1 + memory_tolerance) + MEMORY_MARGIN:
+                status += " <= more memory"
+        
+        if not status:
+            continue
+        if "<=" in status:
+            regressions.append(name)
+        print "%s:%s" % (name, status)
+    return regressions
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Benchmark of the canvas rendering")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES,
+                        help="sizes of the images to test (px)")
+    parser.add_argument("-o", "--output", help="file to write the results (JSON)")
+    parser.add_argument("-b", "--baseline", help="results to compare with (JSON)")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.2,
+                        help="relative slowdown accepted compared to the baseline")
+    parser.add_argument("-m", "--memory-tolerance", type=float, default=0.2,
+                        help="relative increase of memory usage accepted compared to the baseline")
+    options = parser.parse_args(args[1:])
+
+    bench = Benchmark()
+    try:
+        for size in options.sizes:
+            bench.run_size(size)
+    finally:
+        bench.close()
+    report = bench.get_report()
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, options.tolerance,
+                              options.memory_tolerance)
+        if regressions:
+            print "%d scenarios worse than the baseline" % len(regressions)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
+
+# vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
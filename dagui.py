@@ -18,7 +18,9 @@ You should have received a copy of the GNU General Public License along with Del
 
 from dblmscopecanvas import DblMicroscopeCanvas
 from dblmscopepanel import DblMicroscopePanel
-from instrmodel import SECOMModel, InstrumentalImage
+from imageloader import ImageLoader
+from instrmodel import SECOMModel
+import model
 import os
 import wx
 
@@ -35,6 +37,8 @@ class DAGuiFrame(wx.Frame):
         # Statusbar
         #self.CreateStatusBar() # XXX needed?
         self.secom_model = SECOMModel()
+        # decodes the image files in the background
+        self.loader = ImageLoader()
         
         # Setting up the menu.
         menuBar = wx.MenuBar()
@@ -85,6 +89,8 @@ class DAGuiFrame(wx.Frame):
         dlg.Destroy()
 
     def OnClose(self, e):
+        self.loader.Cancel()
+        self.secom_model.Stop()
         self.Destroy()
         
     def OnOpen(self, e):
@@ -98,30 +104,56 @@ class DAGuiFrame(wx.Frame):
             self.dirname = dlg.GetDirectory()
         dlg.Destroy()
         
-        for i, f in enumerate(filenames):
-            try:
+        # one image per detector
+        avs = [self.secom_model.sem_det_image, self.secom_model.optical_det_image]
+        if len(filenames) > len(avs):
+            message = ("Only %d images can be displayed, the other ones are "
+                       "not opened:\n%s" % (len(avs), "\n".join(filenames[len(avs):])))
+            dlg = wx.MessageDialog(self, message, "Too many images selected",
+                                   wx.OK | wx.ICON_WARNING)
+            dlg.ShowModal() # blocking
+            dlg.Destroy()
+        
+        # the images are decoded in the background, and each of them is
+        # displayed as soon as it is ready (a placeholder until then)
+        self.loader.Cancel()
+        with model.batch():
+            for i, f in enumerate(filenames[:len(avs)]):
                 fullname = os.path.join(self.dirname, f)
-                im = InstrumentalImage(wx.Image(fullname),  0.0001 + (0.000015 *i), (0.00001,0.00001))
-
-                if i == 0:
-                    self.secom_model.sem_det_image.value = im
-                elif i == 1:
-                    self.secom_model.optical_det_image.value = im
-            except e:
-                print e
+                self.loader.Load(fullname, 0.0001 + (0.000015 *i), (0.00001,0.00001), avs[i],
+                                 callback=self.OnLoadDone)
 
     def OnLoadExample1(self, e):
         """ Open the two files for example """
-        try:
-            name1 = "1-optical-rot7.png"
-            im1 = InstrumentalImage(wx.Image(name1), 7.14286e-7, (0.0,0.0))
-            self.secom_model.optical_det_image.value = im1
-            
-            name2 = "1-sem-bse.png"
-            im2 = InstrumentalImage(wx.Image(name2), 4.54545e-7, (2e-6, -1e-5))
-            self.secom_model.sem_det_image.value = im2
-        except e:
-            print e
+        self.loader.Cancel()
+        with model.batch():
+            self.loader.Load("1-optical-rot7.png", 7.14286e-7, (0.0,0.0),
+                             self.secom_model.optical_det_image,
+                             callback=self.OnLoadDone)
+            self.loader.Load("1-sem-bse.png", 4.54545e-7, (2e-6, -1e-5),
+                             self.secom_model.sem_det_image,
+                             callback=self.OnLoadDone)
+
+    def OnLoadDone(self, request):
+        """
+        Called (from a loading thread) when an image file has been loaded
+        request (LoadRequest)
+        """
+        if request.error is not None:
+            wx.CallAfter(self.ShowLoadError, request)
+
+    def ShowLoadError(self, request):
+        """
+        Tells the user that an image file couldn't be opened
+        request (LoadRequest): the failed loading
+        """
+        if not self: # the window has been closed in the meantime
+            return
+        message = "Failed to open %s:\n%s" % (request.filename, request.error)
+        dlg = wx.MessageDialog(self, message, "Cannot open image",
+                               wx.OK | wx.ICON_ERROR)
+        dlg.ShowModal() # blocking
+        dlg.Destroy()
 
     def ToggleCross(self, e):
         """
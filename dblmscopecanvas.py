@@ -16,11 +16,15 @@ Delmic Acquisition Software is distributed in the hope that it will be useful, b
 You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
 '''
 
+from boxindex import BoxIndex
 from draggablecanvas import DraggableCanvas, WorldToBufferPoint
+import numpy
 import wx
 
 CROSSHAIR_COLOR = wx.GREEN
 CROSSHAIR_SIZE = 16
+MARKER_COLOR = wx.RED
+MARKER_SIZE = 4 # px
 class DblMicroscopeCanvas(DraggableCanvas):
     """
     A draggable, flicker-free window class adapted to show pictures of two
@@ -88,17 +92,29 @@ class DblMicroscopeCanvas(DraggableCanvas):
         scale = 2.0 ** inc
         self.viewmodel.mpp.value /= scale
 
+    def ReCenterBuffer(self, pos):
+        """
+        Update the position of the buffer on the world, and of the view model
+        pos (2-tuple float): the world coordinates of the center of the buffer
+        The view is displayed immediately at the new position, while the
+        stage is moved (later) to follow it.
+        """
+        DraggableCanvas.ReCenterBuffer(self, pos)
+        self.viewmodel.center.value = (self.world_pos[0] * self.mpwu,
+                                       self.world_pos[1] * self.mpwu)
+
     def avOnMPP(self, mpp):
-        self.scale = self.mpwu / mpp               
-        self.ShouldUpdateDrawing()
+        self.SetScale(self.mpwu / mpp)
     
     def avOnImage(self, image):
         for i in range(len(self.Images)):
-            iim = self.viewmodel.images[i].value
-            if iim.image:
+            av = self.viewmodel.images[i]
+            iim = av.value
+            if iim.image is not None:
                 scale = float(iim.mpp) / self.mpwu
                 pos = (iim.center[0] / self.mpwu, iim.center[1] / self.mpwu)
-                self.SetImage(i, iim.image, pos, scale)
+                # pass the whole InstrumentalImage to benefit from its pyramid
+                self.SetImage(i, iim, pos, scale, av.version)
             else:
                 self.SetImage(i, None)
 
@@ -139,6 +155,76 @@ class CrossHairOverlay(object):
 
         dc.DrawLine(tl_s[0], center[1], br_s[0], center[1])
         dc.DrawLine(center[0], tl_s[1], center[0], br_s[1]) 
+
+class MarkerOverlay(object):
+    """
+    Many markers (ex: particles, regions of interest), drawn all at once.
+    Points are drawn as small crosses (of the same size whatever the zoom),
+    and rectangles at their size in the world. They are kept in numpy arrays
+    with a spatial index, so that only the ones inside the buffer are
+    converted and drawn. The canvas must be updated (ShouldUpdateDrawing())
+    after changing the markers.
+    """
+    def __init__(self, color=MARKER_COLOR, size=MARKER_SIZE):
+        """
+        color (wx.Colour)
+        size (int): half the width of the crosses (in px)
+        """
+        self.pen = wx.Pen(color)
+        self.size = size
+        self._points = BoxIndex(numpy.zeros((0, 4)))
+        self._rectangles = BoxIndex(numpy.zeros((0, 4)))
+
+    def SetPoints(self, points):
+        """
+        points (numpy array (N, 2) of float): position of each point (in world
+          coordinates)
+        """
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+        self._points = BoxIndex(numpy.hstack([points, points]))
+
+    def SetRectangles(self, rects):
+        """
+        rects (numpy array (N, 4) of float): left, top, right, bottom of each
+          rectangle (in world coordinates)
+        """
+        self._rectangles = BoxIndex(rects)
+
+    def Draw(self, dc, shift=(0,0), scale=1.0):
+        """
+        Draws the markers inside the buffer
+        dc (wx.DC): with the origin at the center of the buffer
+        shift (2-tuple float): shift for the coordinate conversion
+        scale (float): scale for the coordinate conversion
+        """
+        # the area of the buffer in world coordinates (with the crosses which
+        # are partly inside)
+        size = dc.GetSize()
+        margin = self.size + 1
+        area = (shift[0] - (size[0] / 2 + margin) / scale,
+                shift[1] - (size[1] / 2 + margin) / scale,
+                shift[0] + (size[0] / 2 + margin) / scale,
+                shift[1] + (size[1] / 2 + margin) / scale)
+        
+        dc.SetPen(self.pen)
+        points = self._points.boxes[self._points.Query(area), 0:2]
+        if len(points):
+            # same conversion as WorldToBufferPoint(), on all the points
+            pos = numpy.round((points - shift) * scale).astype(numpy.int32)
+            s = self.size
+            lines = numpy.empty((len(pos) * 2, 4), dtype=numpy.int32)
+            lines[0::2] = numpy.hstack([pos - (s, 0), pos + (s, 0)])
+            lines[1::2] = numpy.hstack([pos - (0, s), pos + (0, s)])
+            dc.DrawLineList(lines.tolist())
+        
+        rects = self._rectangles.boxes[self._rectangles.Query(area)]
+        if len(rects):
+            tl = numpy.round((rects[:, 0:2] - shift) * scale)
+            br = numpy.round((rects[:, 2:4] - shift) * scale)
+            # at least 1 px, to be visible
+            wh = numpy.maximum(br - tl, 1)
+            dc.SetBrush(wx.TRANSPARENT_BRUSH)
+            dc.DrawRectangleList(numpy.hstack([tl, wh]).astype(numpy.int32).tolist())
         
 
         
@@ -15,10 +15,12 @@ Delmic Acquisition Software is distributed in the hope that it will be useful, b
 
 You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
 '''
-from dblmscopecanvas import DblMicroscopeCanvas
+from dblmscopecanvas import DblMicroscopeCanvas, MarkerOverlay
 from dblmscopeviewmodel import DblMscopeViewModel
 from draggablecanvas import WorldToBufferPoint
 from instrmodel import SECOMModel, InstrumentalImage
+import numpy
+import threading
 import time
 import unittest
 import wx
@@ -34,6 +36,20 @@ def loop():
         if not app.Pending():
             break
 
+def wait_redraw(canvas, timeout=5):
+    """
+    Wait until the canvas has displayed all the changes requested
+    returns (FrameFuture): the frame displayed
+    """
+    future = canvas.GetFrameFuture()
+    start = time.time()
+    while not future.done():
+        if time.time() - start > timeout:
+            raise IOError("Canvas not updated after %g s" % timeout)
+        loop()
+        time.sleep(0.001)
+    return future
+
 class TestDblMicroscopeCanvas(unittest.TestCase):
 
     def setUp(self):
@@ -84,10 +100,7 @@ class TestDblMicroscopeCanvas(unittest.TestCase):
         self.model.merge_ratio.value = ratio
         self.assertEqual(ratio, self.model.merge_ratio.value)
         
-        loop()
-        # it's supposed to update in less than 1s
-        time.sleep(1)
-        loop()
+        wait_redraw(self.canvas)
 
         # copy the buffer into a nice image here
         resultIm = GetImageFromBuffer(self.canvas)
@@ -99,9 +112,7 @@ class TestDblMicroscopeCanvas(unittest.TestCase):
 
         # remove first picture
         self.model.images[0].value = InstrumentalImage(None, None, None)
-        loop()
-        time.sleep(1)
-        loop()
+        wait_redraw(self.canvas)
         
         resultIm = GetImageFromBuffer(self.canvas)
         px2 = GetRGB(resultIm, self.canvas.buffer_size[0]/2 + 200, self.canvas.buffer_size[1]/2 + 200)
@@ -130,10 +141,7 @@ class TestDblMicroscopeCanvas(unittest.TestCase):
         self.model.merge_ratio.value = ratio
         self.assertEqual(ratio, self.model.merge_ratio.value)
         
-        loop()
-        # it's supposed to update in less than 1s
-        time.sleep(1)
-        loop()
+        wait_redraw(self.canvas)
 
         # copy the buffer into a nice image here
         resultIm = GetImageFromBuffer(self.canvas)
@@ -158,9 +166,7 @@ class TestDblMicroscopeCanvas(unittest.TestCase):
         shift = (10,10)
         self.canvas.ShiftView(shift)
 
-        loop()
-        time.sleep(1)
-        loop()
+        wait_redraw(self.canvas)
         resultIm = GetImageFromBuffer(self.canvas)
         
         px1 = GetRGB(resultIm, 
@@ -171,9 +177,7 @@ class TestDblMicroscopeCanvas(unittest.TestCase):
         # zoom in
         self.canvas.Zoom(2)
         self.assertEqual(mpp / (2 ** 2), self.model.mpp.value)
-        loop()
-        time.sleep(1)
-        loop()
+        wait_redraw(self.canvas)
         resultIm = GetImageFromBuffer(self.canvas)
         
         px1 = GetRGB(resultIm, 
@@ -181,6 +185,248 @@ class TestDblMicroscopeCanvas(unittest.TestCase):
              self.canvas.buffer_size[1]/2 + 40)
         self.assertEqual(px1, (255, 0, 0))
 
+
+    def test_TilesReused(self):
+        mpp = 0.0001
+        self.model.mpp.value = mpp
+        im1 = wx.EmptyImage(201, 201, clear=True)
+        self.model.images[0].value = InstrumentalImage(im1, mpp, (0,0))
+        wait_redraw(self.canvas)
+        tiles = dict(self.canvas._tiles)
+        self.assertTrue(len(tiles) > 0)
+        
+        # after a small move, most of the tiles must be exactly the same
+        self.canvas.ShiftView((10, 0))
+        wait_redraw(self.canvas)
+        for k, t in self.canvas._tiles.items():
+            if k in tiles:
+                self.assertTrue(tiles[k] is t)
+        
+        # zoom => everything is recomputed
+        self.canvas.Zoom(1)
+        wait_redraw(self.canvas)
+        kept = [k for k, t in self.canvas._tiles.items() if k in tiles and tiles[k] is t]
+        self.assertEqual(kept, [])
+
+    def test_ZoomPreview(self):
+        mpp = 0.0001
+        self.model.mpp.value = mpp
+        # a white square of 30 px
+        im = numpy.empty((3, 3), dtype=numpy.uint8)
+        im.fill(255)
+        self.model.images[0].value = InstrumentalImage(im, mpp * 10, (0,0))
+        wait_redraw(self.canvas)
+        
+        # the rendering at the new zoom is blocked until we release it
+        release = threading.Event()
+        compute = self.canvas._renderer._compute
+        def blocked_compute(request):
+            release.wait(5)
+            return compute(request)
+        self.canvas._renderer._compute = blocked_compute
+        try:
+            self.canvas.Zoom(1) # => square of 60 px
+            loop()
+            self.assertNotEqual(self.canvas._buffer_scale, self.canvas.scale)
+            
+            # meanwhile, the buffer is scaled to give a preview
+            preview = self.canvas._GetPreview().ConvertToImage()
+            size = self.canvas.ClientSize
+            center = (size[0] / 2, size[1] / 2)
+            self.assertEqual(GetRGB(preview, center[0], center[1]), (255, 255, 255))
+            self.assertEqual(GetRGB(preview, center[0] + 25, center[1]), (255, 255, 255))
+            self.assertEqual(GetRGB(preview, center[0] + 36, center[1]), (0, 0, 0))
+        finally:
+            release.set()
+            self.canvas._renderer._compute = compute
+        
+        # then the actual rendering replaces it
+        wait_redraw(self.canvas)
+        self.assertEqual(self.canvas._buffer_scale, self.canvas.scale)
+        self.assertTrue(self.canvas._preview is None)
+        resultIm = GetImageFromBuffer(self.canvas)
+        center = (self.canvas.buffer_size[0] / 2, self.canvas.buffer_size[1] / 2)
+        self.assertEqual(GetRGB(resultIm, center[0] + 25, center[1]), (255, 255, 255))
+        self.assertEqual(GetRGB(resultIm, center[0] + 29, center[1]), (255, 255, 255))
+        self.assertEqual(GetRGB(resultIm, center[0] + 31, center[1]), (0, 0, 0))
+
+    def test_MergeRatio(self):
+        mpp = 0.0001
+        self.model.mpp.value = mpp
+        im1 = wx.EmptyImage(201, 201, clear=True)
+        im1.SetRGB(100, 100, 255, 0, 0)
+        im2 = wx.EmptyImage(11, 11, clear=True)
+        im2.SetRGB(5, 5, 0, 0, 255)
+        self.model.merge_ratio.value = 0.5
+        self.model.images[0].value = InstrumentalImage(im1, mpp, (0,0))
+        self.model.images[1].value = InstrumentalImage(im2, mpp, (0,0))
+        wait_redraw(self.canvas)
+        computed = self.canvas.metrics.get_counter("tiles_computed")
+        
+        # only the merge ratio changes => the tiles are just merged again
+        self.model.merge_ratio.value = 0.2
+        wait_redraw(self.canvas)
+        self.assertEqual(self.canvas.metrics.get_counter("tiles_computed"), computed)
+        self.assertTrue(self.canvas.metrics.get_counter("tiles_reblended") > 0)
+        
+        resultIm = GetImageFromBuffer(self.canvas)
+        center = (self.canvas.buffer_size[0] / 2, self.canvas.buffer_size[1] / 2)
+        # im1 is bigger, so it's drawn first, and im2 with an opacity of 0.8
+        px = GetRGB(resultIm, center[0], center[1])
+        alpha = int(255 * 0.8)
+        self.assertEqual(px, (255 * (255 - alpha) // 255, 0, 255 * alpha // 255))
+
+    def test_LayersOrderKept(self):
+        mpp = 0.0001
+        self.model.mpp.value = mpp
+        self.model.merge_ratio.value = 0.3
+        im1 = wx.EmptyImage(201, 201, clear=True)
+        im2 = wx.EmptyImage(11, 11, clear=True)
+        self.model.images[0].value = InstrumentalImage(im1, mpp, (0,0))
+        # far away from the first image
+        self.model.images[1].value = InstrumentalImage(im2, mpp, (1.0, 0))
+        wait_redraw(self.canvas)
+        state = self.canvas._tiles_state
+        opacities = self.canvas._tiles_opacities
+        
+        # only the second image in the buffer => still the same opacities
+        self.canvas.ReCenterBuffer((1.0 / self.canvas.mpwu, 0))
+        wait_redraw(self.canvas)
+        self.assertEqual(self.canvas._tiles_state, state)
+        self.assertEqual(self.canvas._tiles_opacities, opacities)
+
+    def test_Mosaic(self):
+        self.model.mpp.value = self.canvas.mpwu # 1 px = 1 world unit
+        # 30x30 fields of 20x20 px, the value of each being its column
+        for i in range(30):
+            for j in range(30):
+                a = numpy.empty((20, 20), dtype=numpy.uint8)
+                a.fill(i)
+                iim = InstrumentalImage(a, 1, None)
+                self.canvas.SetImage(0, iim, (i * 20 - 290, j * 20 - 290), 1, key=(i, j))
+        self.assertEqual(len(self.canvas.Layers[0]), 900)
+        wait_redraw(self.canvas)
+        resultIm = GetImageFromBuffer(self.canvas)
+        center = (self.canvas.buffer_size[0] / 2, self.canvas.buffer_size[1] / 2)
+        self.assertEqual(GetRGB(resultIm, center[0] + 25, center[1]), (16, 16, 16))
+        
+        # only the visible fields are drawn
+        total = self.canvas.metrics.get_counter("tiles_computed")
+        self.assertTrue(total > 0)
+        visible = self.canvas._PrepareRender().layers[0][0]
+        self.assertTrue(0 < len(visible) < 900)
+        
+        # replacing a field => only its tiles are recomputed
+        a = numpy.zeros((20, 20), dtype=numpy.uint8)
+        self.canvas.SetImage(0, InstrumentalImage(a, 1, None), (30, 10), 1, key=(16, 15))
+        wait_redraw(self.canvas)
+        self.assertTrue(self.canvas.metrics.get_counter("tiles_computed") - total <= 4)
+        resultIm = GetImageFromBuffer(self.canvas)
+        self.assertEqual(GetRGB(resultIm, center[0] + 25, center[1] + 5), (0, 0, 0))
+        
+        # removing a field
+        self.canvas.SetImage(0, None, key=(16, 15))
+        self.assertEqual(len(self.canvas.Layers[0]), 899)
+
+    def test_MarkerOverlay(self):
+        self.model.mpp.value = self.canvas.mpwu # 1 px = 1 world unit
+        markers = MarkerOverlay(wx.RED, 3)
+        # many points, but only a few inside the buffer
+        points = numpy.array([(i * 7, 5) for i in range(-1000, 1000)])
+        markers.SetPoints(points)
+        markers.SetRectangles([(-20, -20, -10, -10)])
+        self.canvas.Overlays.append(markers)
+        self.canvas.ShouldUpdateDrawing()
+        wait_redraw(self.canvas)
+        
+        resultIm = GetImageFromBuffer(self.canvas)
+        center = (self.canvas.buffer_size[0] / 2, self.canvas.buffer_size[1] / 2)
+        self.assertEqual(GetRGB(resultIm, center[0] + 7, center[1] + 5), (255, 0, 0))
+        self.assertEqual(GetRGB(resultIm, center[0] + 7, center[1] + 7), (255, 0, 0))
+        self.assertEqual(GetRGB(resultIm, center[0] + 3, center[1] + 3), (0, 0, 0))
+        # border of the rectangle
+        self.assertEqual(GetRGB(resultIm, center[0] - 20, center[1] - 15), (255, 0, 0))
+        self.assertEqual(GetRGB(resultIm, center[0] - 15, center[1] - 15), (0, 0, 0))
+
+    def test_StaticOverlays(self):
+        self.model.crosshair.value = False
+        dc, area = self.canvas._GetStaticOverlays()
+        self.assertTrue(area is None)
+        
+        self.model.crosshair.value = True
+        dc, area = self.canvas._GetStaticOverlays()
+        # only the area of the cross is blitted at each paint
+        size = self.canvas.ClientSize
+        center = (size[0] / 2, size[1] / 2)
+        self.assertTrue(area[0] <= center[0] < area[0] + area[2])
+        self.assertTrue(area[1] <= center[1] < area[1] + area[3])
+        self.assertTrue(area[2] < size[0] or area[3] < size[1])
+        # not redrawn as long as nothing changes
+        self.canvas.drag_shift = (5, 5)
+        self.assertTrue(self.canvas._GetStaticOverlays()[1] is area)
+        
+        self.canvas.UpdateStaticOverlays()
+        self.assertEqual(self.canvas._GetStaticOverlays()[1], area)
+
+    def test_UpdatePeriod(self):
+        canvas = self.canvas
+        canvas.latency_budget = 0.2
+        # the slower the draws, the longer the events are grouped, up to half
+        # the budget
+        periods = []
+        for duration in (0, 0.01, 0.05, 0.1, 0.15, 0.2, 0.5, 2):
+            for i in range(50): # long enough for the average to converge
+                canvas._UpdateDrawDuration(duration)
+            periods.append(canvas._GetUpdatePeriod())
+        self.assertEqual(periods, sorted(periods))
+        self.assertEqual(periods[0], 0.001)
+        self.assertAlmostEqual(periods[2], 0.05)
+        self.assertAlmostEqual(periods[-1], 0.1)
+
+    def test_FrameFuture(self):
+        mpp = 0.0001
+        self.model.mpp.value = mpp
+        im1 = wx.EmptyImage(201, 201, clear=True)
+        self.model.images[0].value = InstrumentalImage(im1, mpp, (0,0))
+        displayed = []
+        future = self.canvas.GetFrameFuture(displayed.append)
+        self.assertFalse(future.done())
+        wait_redraw(self.canvas)
+        self.assertTrue(future.done())
+        self.assertEqual(displayed, [future])
+        self.assertTrue(future.result() >= 0)
+        
+        # nothing changed => just needs a paint
+        future = wait_redraw(self.canvas)
+        self.assertTrue(future.done())
+        
+        # a change after the request is not needed
+        future = self.canvas.GetFrameFuture()
+        self.canvas.ShiftView((10, 0))
+        while not future.done():
+            loop()
+        self.assertTrue(future.changes < self.canvas._changes)
+    
+    def test_FrameFutureFailure(self):
+        mpp = 0.0001
+        self.model.mpp.value = mpp
+        wait_redraw(self.canvas)
+        
+        # the rendering fails => the future is still resolved, with the error
+        def failing_compute(request):
+            raise ValueError("rendering failed")
+        self.canvas._renderer._compute = failing_compute
+        im1 = wx.EmptyImage(201, 201, clear=True)
+        self.model.images[0].value = InstrumentalImage(im1, mpp, (0,0))
+        future = wait_redraw(self.canvas)
+        self.assertTrue(isinstance(future.error, ValueError))
+        self.assertRaises(ValueError, future.result)
+        
+        # works again after the next change
+        self.canvas._renderer._compute = self.canvas._ComputeTiles
+        self.canvas.ShiftView((10, 0))
+        future = wait_redraw(self.canvas)
+        self.assertTrue(future.error is None)
         
 if __name__ == "__main__":
     unittest.main()
@@ -18,8 +18,9 @@ You should have received a copy of the GNU General Public License along with Del
 
 from dblmscopecanvas import DblMicroscopeCanvas
 from dblmscopeviewmodel import DblMscopeViewModel
-from instrmodel import InstrumentalImage
+from instrmodel import InstrumentalImage, FrameRingBuffer
 from scalewindow import ScaleWindow
+import model
 import units
 import wx
 
@@ -37,6 +38,8 @@ class DblMicroscopePanel(wx.Panel):
         
         self.viewmodel = DblMscopeViewModel()
         self.canvas = DblMicroscopeCanvas(self)
+        # the stage follows the view
+        self.viewmodel.center.bind(self.avOnCenter)
         
         # The legend
         # Control for the selection before AddView(), which needs them
@@ -143,6 +146,9 @@ class DblMicroscopePanel(wx.Panel):
         # int(0.58*100) = 57
         self.mergeSlider.SetValue(round(val * 100))
     
+    def avOnCenter(self, center):
+        self.secom_model.stage_pos.value = center
+    
     # TODO need to update HFW on OnSize
     def avOnMPP(self, mpp):
         self.scaleDisplay.SetMPP(mpp)
@@ -193,28 +199,31 @@ class DblMicroscopePanel(wx.Panel):
         
         needSwap = ((oppView == view) and not isinstance(view, MicroscopeEmptyView))
         
-        # Remove old view(s)
-        prevView.Hide(combo, sizer)
-        if needSwap:
-            oppView.Hide(oppCombo, oppSizer)
-            oppView = prevView
-        
-        # Show new view
-        view.Show(combo, sizer, self.viewmodel.images[display])
-        self.displays[display] = (view, combo, sizer)
-        if needSwap:
-            oppView.Show(oppCombo, oppSizer, self.viewmodel.images[oppDisplay])
-            self.displays[oppDisplay] = (oppView, oppCombo, oppSizer)
-        
-        # Remove slider if not 2 views
-        if isinstance(view, MicroscopeEmptyView) or isinstance(oppView, MicroscopeEmptyView):
-            self.mergeSlider.Hide()
-        else:
-            self.mergeSlider.Show()
+        # The images and merge ratio change together: the canvas is notified
+        # only once everything is in place
+        with model.batch():
+            # Remove old view(s)
+            prevView.Hide(combo, sizer)
+            if needSwap:
+                oppView.Hide(oppCombo, oppSizer)
+                oppView = prevView
+            
+            # Show new view
+            view.Show(combo, sizer, self.viewmodel.images[display])
+            self.displays[display] = (view, combo, sizer)
+            if needSwap:
+                oppView.Show(oppCombo, oppSizer, self.viewmodel.images[oppDisplay])
+                self.displays[oppDisplay] = (oppView, oppCombo, oppSizer)
             
-        # TODO: find out if that's the nice behaviour, or should just keep it?
-        if needSwap:
-            self.viewmodel.merge_ratio.value = (1.0 -  self.viewmodel.merge_ratio.value)
+            # Remove slider if not 2 views
+            if isinstance(view, MicroscopeEmptyView) or isinstance(oppView, MicroscopeEmptyView):
+                self.mergeSlider.Hide()
+            else:
+                self.mergeSlider.Show()
+                
+            # TODO: find out if that's the nice behaviour, or should just keep it?
+            if needSwap:
+                self.viewmodel.merge_ratio.value = (1.0 -  self.viewmodel.merge_ratio.value)
         
         assert(self.displays[0] != self.displays[1] or 
                isinstance(self.displays[0], MicroscopeEmptyView))
@@ -291,8 +300,39 @@ class MicroscopeImageView(MicroscopeView):
         self.LegendMag = wx.StaticText(parent)
         self.legendCtrl.append(self.LegendMag)
         
-        iim.bind(self.avImage)
+        # The images can come faster than they are displayed (and from another
+        # thread): only the latest one is displayed, once the previous one is.
+        self.canvas = parent.canvas
+        self.frames = FrameRingBuffer()
+        self._frame_future = None # display of the last frame
+        iim.bind(self.avNewFrame)
         viewmodel.mpp.bind(self.avMPP, True)
+    
+    def avNewFrame(self, value):
+        """
+        Called for each new image, possibly in the thread of the detector
+        """
+        if self.frames.Put(value):
+            if wx.Thread_IsMain():
+                self.DisplayLatestFrame()
+            else:
+                wx.CallAfter(self.DisplayLatestFrame)
+    
+    def DisplayLatestFrame(self):
+        """
+        Displays the newest image received, unless the previous one is not
+        yet displayed (in which case it will be called again afterwards)
+        """
+        if self._frame_future and not self._frame_future.done():
+            return
+        im = self.frames.GetLatest()
+        if im is None:
+            return
+        self.avImage(im)
+        self._frame_future = self.canvas.GetFrameFuture(self._OnFrameDisplayed)
+    
+    def _OnFrameDisplayed(self, future):
+        self.DisplayLatestFrame()
                 
     def avImage(self, value):
         self.inimage = value
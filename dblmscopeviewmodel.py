@@ -17,7 +17,7 @@ You should have received a copy of the GNU General Public License along with Del
 '''
 
 from instrmodel import InstrumentalImage
-from model import ActiveValue
+from model import ActiveValue, VersionedActiveValue
 
 class DblMscopeViewModel(object):
     """
@@ -33,8 +33,8 @@ class DblMscopeViewModel(object):
         # 0<=float<=1
         self.merge_ratio = ActiveMergeRatio(0.3) # no unit
         
-        self.images = [ActiveValue(InstrumentalImage(None, None, None)),
-                       ActiveValue(InstrumentalImage(None, None, None))]
+        self.images = [VersionedActiveValue(InstrumentalImage(None, None, None)),
+                       VersionedActiveValue(InstrumentalImage(None, None, None))]
         
         # center position of the view
         self.center = ActiveValue((0,0)) # (m, m)
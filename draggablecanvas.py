@@ -15,46 +15,98 @@ Delmic Acquisition Software is distributed in the hope that it will be useful, b
 
 You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
 '''
-import ctypes
+from imagecache import ImageCache
+from imagelayer import ImageLayer
+from imaging import GetImageArray, GetRGBView
 import math
+import numpy
 import os
+from rendermetrics import RenderMetrics
+import threading
 import time
+import traceback
 import wx
 
+# colour of the background of the static overlays, which is kept transparent
+STATIC_MASK_COLOUR = (255, 0, 255)
+# above this number of areas to repaint, the box around them is repainted
+MAX_PAINT_RECTS = 8
+
 # A class for smooth, flicker-less display of anything on a window, with drag 
 # and zoom capability a bit like:
 # wx.canvas, wx.BufferedWindow, BufferedCanvas, wx.floatcanvas, wx.scrolledwindow...
 # The main differences are:
 #  * when dragging the window the surrounding margin is already computed
 #  * You can draw at any coordinate, and it's displayed if the user has dragged the canvas close from the area.
-#  * Built-in optimised zoom/transparency for 2 images
+#  * Built-in optimised zoom/transparency for 2 layers of images (merged with numpy)
 # Maybe could be replaced by a GLCanvas + magic, or a Cairo Canvas
 class DraggableCanvas(wx.Panel):
     """
     A draggable, buffered window class.
 
     To use it, instantiate it and then put what you want to display in the lists:
-    * Images: for the two images to display
+    * Layers: the two layers of images to display, each of them can contain
+      many images (ex: a mosaic), see SetImage()
     * Overlays: for additional objects to display (should have a Draw(dc) method)
     * StaticOverlays: for additional objects that stay at an absolute position
+      (call UpdateStaticOverlays() after changing one of them)
     
     The idea = three layers of decreasing area size:
     * The whole world, which can have infinite dimensions, but needs a redraw
     * The buffer, which contains a precomputed image of the world big enough that a drag cannot bring it outside of the viewport
     * The viewport, which is what the user sees
 
+    The images are computed by tiles, aligned on the "world pixels" (= world
+    coordinates * scale). When the buffer is moved, only the tiles which were
+    not yet in the buffer need to be computed.
     """
     def __init__(self, parent):
         wx.Panel.__init__(self, parent, style=wx.NO_FULL_REPAINT_ON_RESIZE)
         self.Overlays = [] # on top of the pictures, relative position
         self.StaticOverlays = [] # on top, stays at an absolute position
-        self.Images = [None, None]
+        self.Layers = [ImageLayer(), ImageLayer()]
         self.merge_ratio = 0.3
+        # the rescaled images, to avoid recomputing them when only the
+        # overlays or the merge ratio change. max_size can be adjusted.
+        self.rescale_cache = ImageCache(64 * 2**20) # bytes
+        # The merged images by tiles, reused as long as only the position changes
+        self.tile_size = 256 # px
+        self._tiles = {} # (int, int) -> wx.Bitmap (or None if empty)
+        self._tiles_state = None # parameters used to compute the tiles
+        # The layers of each tile, as drawn before being merged, so that when
+        # only the opacities change, they are just merged again
+        self._tiles_layers = {} # (int, int) -> list of drawn layers (see _DrawLayer())
+        self._tiles_opacities = None # opacities used to merge the tiles
+        # When an image changes, only the tiles on its area are recomputed.
+        # The areas changed are kept until all the requests computed before
+        # are done, to know which of their tiles are outdated.
+        self._content_version = 0 # increased at each area changed
+        self._changed_areas = [] # (content version, rect in world units)
+        self._tiles_mappings = {} # id -> (image, mapping) of the images drawn
 #        self.zoom = 0 # float, can also be negative
         self.scale = 1.0 # derived from zoom
 #        self.zoom_range = (-10.0, 10.0)
         
         self.world_pos = (0,0) # position of the centre of the buffer in the world
+        # what the buffer actually contains (it's updated asynchronously)
+        self._buffer_center = (0,0) # in world pixels
+        self._buffer_scale = self.scale
+        self._buffer_state = None # state of the tiles drawn in the buffer
+        # view displayed while the buffer is not yet at the right scale
+        self._preview = None # (key, wx.Bitmap)
+        # the static overlays, drawn once on a transparent bitmap, and blitted
+        # on the window only where it's repainted (see _GetStaticOverlays())
+        self._static_overlays = None # (key, wx.MemoryDC, rect)
+        self._dcStatic = wx.MemoryDC()
+        # True if the buffer has to be completely redrawn (not just moved)
+        self._needs_full_redraw = True
+        # number of changes requested, and how many are taken into account in
+        # the buffer, to know when a frame is up to date (see GetFrameFuture())
+        self._changes = 0
+        self._buffer_changes = 0
+        # number of changes for which the rendering failed (and the error)
+        self._failed_changes = (0, None)
+        self._frame_futures = [] # FrameFuture not yet resolved
         
         # buffer = the whole image to be displayed
         self._dcBuffer =  wx.MemoryDC()
@@ -77,6 +129,17 @@ class DraggableCanvas(wx.Panel):
         
         # timer to give a delay before redrawing so we wait to see if there are several events waiting
         self.DrawTimer = wx.PyTimer(self.OnDrawTimer)
+        # Maximum time (s) wished between a change and the display of the
+        # updated buffer. It can be changed by the user of the canvas. The
+        # delay before redrawing adapts to the duration of the draws, within
+        # this budget (see ShouldUpdateDrawing()).
+        self.latency_budget = 0.2
+        self._draw_duration = 0.02 # s, average of the recent draws
+        # the images are computed in a separate thread, to keep the GUI reactive
+        self._render_generation = 0 # increased at each new request
+        self._renderer = RenderThread(self._ComputeTiles, self._OnRenderDone)
+        self._renderer.start()
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.OnDestroy)
         
         self.Bind(wx.EVT_PAINT, self.OnPaint)
         self.Bind(wx.EVT_SIZE, self.OnSize)
@@ -90,7 +153,14 @@ class DraggableCanvas(wx.Panel):
 
         self.Bind(wx.EVT_CHAR, self.OnChar)
         
-        self.n = 0
+        # Time spent in each stage of the rendering, and various counts
+        # (draws, paints, cache_hits...). See RenderMetrics.
+        self.metrics = RenderMetrics()
+        
+    def OnDestroy(self, event):
+        if event.GetEventObject() is self:
+            self._renderer.Stop()
+        event.Skip()
         
     def OnChar(self, event):
         key = event.GetKeyCode()
@@ -114,10 +184,25 @@ class DraggableCanvas(wx.Panel):
     def OnRightUp(self, event):
         self.ShouldUpdateDrawing()
     
+    def SetScale(self, scale):
+        """
+        Changes the zoom of the view. A preview is displayed immediately, by
+        scaling the current content of the buffer, until the buffer is
+        recomputed at the new scale.
+        scale (0<float): new scale
+        """
+        if self.scale == scale:
+            return
+        self.scale = scale
+        self.ShouldUpdateDrawing()
+        self.Refresh(eraseBackground=False)
+        
     def ShiftView(self, shift):
         """
         Moves the position of the view by a delta
         shift (2-tuple int): delta in buffer coordinates (pixels)
+        The view is updated immediately from the buffer margin, and then the
+        content of the buffer is moved, with only the exposed strips redrawn.
         """
         self.ReCenterBuffer((self.world_pos[0] - (shift[0] / self.scale),
                             self.world_pos[1] - (shift[1] / self.scale)))
@@ -134,19 +219,12 @@ class DraggableCanvas(wx.Panel):
         # Get the focus back when receiving a click
         self.SetFocus()
         
-#        self.t_start = time.time()
-#        self.n = 0
-        
     def OnLeftUp(self, event):
         self.dragging = False
         self.SetCursor(wx.STANDARD_CURSOR)
         if self.HasCapture():
             self.ReleaseMouse()
         self.ReCenterBufferAroundView()
-        
-#        t_now = time.time()
-#        fps = self.n / float(t_now - self.t_start)
-#        print "Display speed: " + str(fps) + " fps."
     
     def OnMouseMotion(self, event):
         if self.dragging:
@@ -155,7 +233,7 @@ class DraggableCanvas(wx.Panel):
                      pos[1] - self.drag_init_pos[1])
             self.drag_shift = (self.drag_init_viewpos[0] + shift[0],
                                self.drag_init_viewpos[1] + shift[1])
-            self.Refresh()
+            self.Refresh(eraseBackground=False)
 
     def OnDblClick(self, event):
         pos = event.GetPositionTuple()
@@ -164,46 +242,233 @@ class DraggableCanvas(wx.Panel):
                    self.world_pos[1] + (pos[1] - center[1]) / self.scale)
         self.ReCenterBuffer(new_pos)
 
+    @property
+    def Images(self):
+        """
+        The main image of each layer (see SetImage()), or None
+        """
+        return [l.Get(None) for l in self.Layers]
+
     # Change picture one/two
-    def SetImage(self, index, im, pos = None, scale = None):
+    def SetImage(self, index, im, pos = None, scale = None, version = None, key = None):
         """
-        Set (or update) the image
-        index (int, 0 or 1): index number of the image
-        im (wx.Image): the image, or None to remove the current image
+        Set (or update) an image
+        index (0<=int<len(Layers)): index number of the layer of the image
+        im (wx.Image or InstrumentalImage): the image, or None to remove the
+          current image. An InstrumentalImage is displayed faster when reduced
+          (thanks to its pyramid). Its content should not be modified
+          afterwards (as the rescaled versions are cached), set a new image
+          instead.
         pos (2-tuple of float): position of the center of the image (in world unit)
         scale (float): scaling of the image
+        version: anything which changes when the content of the image changes
+          (ex: VersionedActiveValue.version). Needed only if the image can be
+          modified.
+        key (hashable): identifies the image in the layer. A layer can contain
+          many images (ex: the fields of a mosaic), only the ones visible are
+          drawn. None is for the main image of the layer.
         """
-        assert(0 <= index and index <= 1)
+        assert(0 <= index and index < len(self.Layers))
+        layer = self.Layers[index]
+        
+        prev_im = layer.Get(key)
+        if (prev_im is im and im and im._dc_center == pos and
+            im._dc_scale == scale and im._dc_version == version):
+            self.ShouldUpdateDrawing() # nothing changed in the layer
+            return
+        
+        if prev_im:
+            # only the area of the image changed has to be redrawn
+            self._InvalidateArea(ImageLayer.GetImageRect(prev_im))
+            layer.Remove(key)
+            # the rescaled versions of a replaced image are useless now
+            if prev_im is not im:
+                if not any(prev_im in l for l in self.Layers):
+                    self.rescale_cache.forget(prev_im)
+            elif im._dc_version != version:
+                self.rescale_cache.forget(im)
         
         if not im:
-            self.Images[index] = None
+            if prev_im:
+                self.ShouldUpdateDrawing()
             return
         
         im._dc_center = pos
         im._dc_scale = scale
-        if not im.HasAlpha():
-            im.InitAlpha()
-        self.Images[index] = im
+        im._dc_version = version
+        layer.Add(key, im)
+        self._InvalidateArea(ImageLayer.GetImageRect(im))
         self.ShouldUpdateDrawing()
 
+    def _InvalidateArea(self, rect):
+        """
+        Drops the tiles of an area, and records it so that the tiles being
+        computed for this area are not used
+        rect (4-tuple float): left, top, right, bottom (in world units)
+        """
+        self._content_version += 1
+        self._changed_areas.append((self._content_version, rect))
+        tiles = self._GetTilesRange(rect, self.scale, self.tile_size)
+        for t in [t for t in self._tiles if IsTileInRange(t, tiles)]:
+            del self._tiles[t]
+        for t in [t for t in self._tiles_layers if IsTileInRange(t, tiles)]:
+            del self._tiles_layers[t]
+
+    @staticmethod
+    def _GetTilesRange(rect, scale, tile_size):
+        """
+        rect (4-tuple float): left, top, right, bottom (in world units)
+        scale (float): scale of the world pixels
+        tile_size (int)
+        returns (4-tuple int): the first and last tiles (included) which
+          intersect the area: left, top, right, bottom
+        """
+        # 1 px more on each side, as the images are rounded to the pixel
+        ts = float(tile_size)
+        return (int(math.floor((rect[0] * scale - 1) / ts)),
+                int(math.floor((rect[1] * scale - 1) / ts)),
+                int(math.floor((rect[2] * scale + 1) / ts)),
+                int(math.floor((rect[3] * scale + 1) / ts)))
 
     def OnPaint(self, event):
         """
         Quick update of the window content with the buffer + the static overlays
+        Only the areas of the window which need to be repainted are updated.
         """
+        t_start = time.time()
         dc = wx.PaintDC(self)
-        margin = ((self.buffer_size[0] - self.ClientSize[0])/2,
-                  (self.buffer_size[1] - self.ClientSize[1])/2)
-
-#        dc.BlitPointSize(self.drag_shift, self.buffer_size, self._dcBuffer, (0,0))
-#        print (margin[0] - self.drag_shift[0], margin[1] - self.drag_shift[1])
-        dc.BlitPointSize((0,0), self.ClientSize, self._dcBuffer, 
-                         (margin[0] - self.drag_shift[0], margin[1] - self.drag_shift[1]))
-        # TODO do this only when drag_shift changes, and record the modified region before and put back after.
-        self.DrawStaticOverlays(dc)
+        rects = self._GetUpdateRects()
+        if self._buffer_scale != self.scale:
+            # The buffer is not yet at the right zoom
+            dc.DrawBitmapPoint(self._GetPreview(), (0, 0))
+        else:
+            self._preview = None
+            margin = ((self.buffer_size[0] - self.ClientSize[0])/2,
+                      (self.buffer_size[1] - self.ClientSize[1])/2)
+            # The buffer might not be yet centred on world_pos
+            offset = (int(round(self.world_pos[0] * self._buffer_scale)) - self._buffer_center[0],
+                      int(round(self.world_pos[1] * self._buffer_scale)) - self._buffer_center[1])
+            src = (margin[0] + offset[0] - self.drag_shift[0],
+                   margin[1] + offset[1] - self.drag_shift[1])
+            for r in rects:
+                dc.BlitPointSize(r[0:2], r[2:4], self._dcBuffer,
+                                 (src[0] + r[0], src[1] + r[1]))
+        
+        # The static overlays are only redrawn when they change, otherwise
+        # they are just put back on top of the part repainted
+        dcStatic, area = self._GetStaticOverlays()
+        if area:
+            for r in rects:
+                inter = IntersectRect(r, area)
+                if inter:
+                    dc.BlitPointSize(inter[0:2], inter[2:4], dcStatic,
+                                     inter[0:2], useMask=True)
         
-#        self.n += 1 # for fps
+        self.metrics.add_time("paint", time.time() - t_start)
+        self.metrics.count("paints")
+        if self._buffer_scale == self.scale:
+            self._ResolveFrameFutures()
+
+    def GetFrameFuture(self, callback=None):
+        """
+        Gives a way to know when all the changes requested up to now are
+        displayed: the future is resolved after the window has been painted
+        with a buffer taking them into account.
+        callback (callable): called with the future (in the GUI thread), once
+          it is resolved
+        returns (FrameFuture)
+        """
+        future = FrameFuture(self._changes)
+        if callback:
+            future.add_done_callback(callback)
+        if self._buffer_changes < self._changes <= self._failed_changes[0]:
+            # the last rendering failed, and nothing has changed since
+            future._resolve(self._failed_changes[1])
+            return future
+        self._frame_futures.append(future)
+        if self._buffer_changes >= self._changes:
+            # the buffer is already up to date, it just needs to be painted
+            self.Refresh(eraseBackground=False)
+        return future
+
+    def _FailFrameFutures(self, changes, error):
+        """
+        Resolve, with an error, the futures which were waiting for changes
+        whose rendering failed
+        changes (int): number of changes of the failed rendering
+        error (Exception): the error which happened
+        """
+        self._failed_changes = (changes, error)
+        waiting = []
+        for f in self._frame_futures:
+            if self._buffer_changes < f.changes <= changes:
+                f._resolve(error)
+            else:
+                waiting.append(f)
+        self._frame_futures = waiting
+
+    def _ResolveFrameFutures(self):
+        """
+        Resolve the futures which are satisfied by the buffer just painted
+        """
+        if not self._frame_futures:
+            return
+        waiting = []
+        for f in self._frame_futures:
+            if f.changes <= self._buffer_changes:
+                f._resolve()
+            else:
+                waiting.append(f)
+        self._frame_futures = waiting
 
+    def _GetPreview(self):
+        """
+        Computes an approximation of the view by scaling the part of the
+        buffer displayed. It is used while the buffer is recomputed at the new
+        scale. The cost only depends on the size of the window.
+        returns (wx.Bitmap): the view, of the size of the window
+        """
+        key = (self.scale, self.world_pos, self.drag_shift, tuple(self.ClientSize),
+               self._buffer_center, self._buffer_scale, self._buffer_state)
+        if self._preview and self._preview[0] == key:
+            return self._preview[1]
+        
+        size = self.ClientSize
+        preview = wx.EmptyBitmap(*size)
+        dcPreview = wx.MemoryDC()
+        dcPreview.SelectObject(preview)
+        dcPreview.SetBackground(wx.BLACK_BRUSH)
+        dcPreview.Clear()
+        
+        zoom = self.scale / self._buffer_scale
+        # the part of the buffer seen, in buffer coordinates (floats)
+        center = (self.world_pos[0] * self._buffer_scale - self._buffer_center[0]
+                  + self.buffer_size[0] / 2 - self.drag_shift[0] / zoom,
+                  self.world_pos[1] * self._buffer_scale - self._buffer_center[1]
+                  + self.buffer_size[1] / 2 - self.drag_shift[1] / zoom)
+        seen = (center[0] - size[0] / (2 * zoom), center[1] - size[1] / (2 * zoom),
+                center[0] + size[0] / (2 * zoom), center[1] + size[1] / (2 * zoom))
+        # only the part inside the buffer (left, top, right, bottom)
+        src = (max(0, int(seen[0])), max(0, int(seen[1])),
+               min(self.buffer_size[0], int(math.ceil(seen[2]))),
+               min(self.buffer_size[1], int(math.ceil(seen[3]))))
+        if src[0] < src[2] and src[1] < src[3]:
+            src_size = (src[2] - src[0], src[3] - src[1])
+            part = wx.EmptyBitmap(*src_size)
+            dcPart = wx.MemoryDC()
+            dcPart.SelectObject(part)
+            dcPart.BlitPointSize((0, 0), src_size, self._dcBuffer, src[0:2])
+            dcPart.SelectObject(wx.NullBitmap)
+            dest_size = (max(1, int(src_size[0] * zoom)), max(1, int(src_size[1] * zoom)))
+            im = part.ConvertToImage().Scale(*dest_size)
+            dcPreview.DrawBitmapPoint(wx.BitmapFromImage(im),
+                                      (int((src[0] - seen[0]) * zoom),
+                                       int((src[1] - seen[1]) * zoom)))
+        dcPreview.SelectObject(wx.NullBitmap)
+        
+        self._preview = (key, preview)
+        return preview
+        
     def OnSize(self, event):
         """
         Ensures that the buffer still fits in the view and recenter the view
@@ -228,7 +493,10 @@ class DraggableCanvas(wx.Panel):
         # Make new offscreen bitmap: this bitmap will always have the
         # current drawing in it
         self._buffer = wx.EmptyBitmap(*size)
+        # a second one, to move the content of the buffer (see _ScrollBuffer())
+        self._buffer_back = wx.EmptyBitmap(*size)
         self.buffer_size = size
+        self._buffer_state = None # empty
         self._dcBuffer.SelectObject(self._buffer)
         self._dcBuffer.SetBackground(wx.BLACK_BRUSH) # On Linux necessary after every select object
         
@@ -246,23 +514,59 @@ class DraggableCanvas(wx.Panel):
         """
         Update the position of the buffer on the world
         pos (2-tuple float): the world coordinates of the center of the buffer
+        The view is immediately centred on this position, while the buffer
+        will actually be moved when it is redrawn.
         """
         if self.world_pos == pos:
             return
         self.world_pos = pos
+        # the view is now centred on world_pos, so reset drag_shift
+        if self.dragging:
+            self.drag_init_viewpos = (self.drag_init_viewpos[0] - self.drag_shift[0],
+                                      self.drag_init_viewpos[1] - self.drag_shift[1])
+        self.drag_shift = (0,0)
         
-        print "should move stage to pos:", self.world_pos
-        
-        # TODO now that we delay the drawing, it should have different worldpos between requested and actual
-        self.ShouldUpdateDrawing() # XXX could maybe be more clever and only request redraw for the outside region
+        # only the tiles of the outside region will be computed, and the rest
+        # of the buffer will be moved
+        self.ShouldUpdateDrawing(moved=True)
+        self.Refresh(eraseBackground=False)
         
-    def ShouldUpdateDrawing(self, period = 0.1):
+    def ShouldUpdateDrawing(self, period = None, moved = False):
         """
         Schedule the update of the buffer
-        period (second): maximum time to wait before it will be updated
+        period (second): maximum time to wait before it will be updated. If
+          None, it is computed from the duration of the recent draws: cheap
+          draws are done almost immediately, while more events are grouped
+          before an expensive one (within the latency_budget).
+        moved (boolean): True if only the position of the buffer has changed,
+          in which case the current content can be partly reused
         """
+        self._changes += 1
+        if not moved:
+            self._needs_full_redraw = True
+        if period is None:
+            period = self._GetUpdatePeriod()
         if not self.DrawTimer.IsRunning():
             self.DrawTimer.Start(period * 1000.0, oneShot=True)
+    
+    def _GetUpdatePeriod(self):
+        """
+        Computes how long to wait before updating the buffer: waiting about
+        the time of a draw costs at most twice the latency, and avoids
+        redrawing for every event. The more expensive the draws, the more
+        events are grouped, up to half the latency_budget.
+        returns (float): the period (in s)
+        """
+        period = min(self._draw_duration, self.latency_budget / 2.0)
+        return max(0.001, period)
+
+    def _UpdateDrawDuration(self, duration):
+        """
+        Takes into account the duration of a draw for the next delays
+        duration (float): time it took (in s)
+        """
+        # exponential moving average => mostly the last draws count
+        self._draw_duration = 0.7 * self._draw_duration + 0.3 * duration
 
     def OnDrawTimer(self):
         self.UpdateDrawing()
@@ -270,26 +574,253 @@ class DraggableCanvas(wx.Panel):
     def UpdateDrawing(self):
         """
         Redraws everything (that is viewed in the buffer)
+        The images are computed in a separate thread, and the buffer is
+        updated once they are ready (see _OnRenderDone()).
         """
-        self.Draw(self._dcBuffer)
-        # everything is redrawn centred, so reset drag_shift
-        if self.dragging:
-            self.drag_init_viewpos = (self.drag_init_viewpos[0] - self.drag_shift[0],
-                                      self.drag_init_viewpos[1] - self.drag_shift[1])
-        self.drag_shift = (0,0)
+        self._render_generation += 1
+        self._renderer.Request(self._PrepareRender())
+    
+    def _PrepareRender(self):
+        """
+        Takes a snapshot of everything needed to compute the buffer, and find
+        out which tiles must be computed
+        returns (RenderRequest)
+        """
+        # where is the buffer in the world?
+        center = self._GetBufferCenter()
+        buffer_rect = (center[0] - self.buffer_size[0] / 2,
+                       center[1] - self.buffer_size[1] / 2,
+                       self.buffer_size[0],
+                       self.buffer_size[1])
+        # only the images visible in the buffer are used
+        area = (buffer_rect[0] / self.scale, buffer_rect[1] / self.scale,
+                (buffer_rect[0] + buffer_rect[2]) / self.scale,
+                (buffer_rect[1] + buffer_rect[3]) / self.scale)
+        visible = [l.Query(area) for l in self.Layers]
+        # the order and opacities only depend on which layers have images,
+        # not on what is in the buffer, so that they don't change when moving
+        order = self._GetLayersOrder([len(l) > 0 for l in self.Layers])
+        layers = [(visible[i], opacity) for i, opacity in order]
+        
+        # The opacities are not part of the state: when only them change, the
+        # layers already drawn are just merged again
+        state = (self.scale, self.tile_size, tuple(i for i, o in order))
+        opacities = tuple(o for i, o in order)
+        if state != self._tiles_state:
+            self._tiles = {}
+            self._tiles_layers = {}
+            self._tiles_state = state
+        elif opacities != self._tiles_opacities:
+            self._tiles = {}
+        self._tiles_opacities = opacities
+        
+        # the images whose display mapping has changed are redrawn
+        mappings = {}
+        for ims in visible:
+            for im in ims:
+                m = getattr(im, "mapping", None)
+                prev = self._tiles_mappings.get(id(im))
+                if prev and prev[0] is im and prev[1] != m:
+                    self._InvalidateArea(ImageLayer.GetImageRect(im))
+                mappings[id(im)] = (im, m)
+        self._tiles_mappings = mappings
+        
+        ts = self.tile_size
+        needed = []
+        for i in range(buffer_rect[0] // ts, (buffer_rect[0] + buffer_rect[2] - 1) // ts + 1):
+            for j in range(buffer_rect[1] // ts, (buffer_rect[1] + buffer_rect[3] - 1) // ts + 1):
+                needed.append((i, j))
+        missing = [t for t in needed if t not in self._tiles]
+        drawn = dict((t, self._tiles_layers[t]) for t in missing
+                     if t in self._tiles_layers)
+        
+        return RenderRequest(self._render_generation, self._changes, state,
+                             center, self.scale, layers, self._content_version,
+                             ts, needed, missing, drawn)
+    
+    def _GetLayersOrder(self, present):
+        """
+        Decides how the layers are drawn: the biggest one is drawn first, so
+        that the outside is not mixed with the black background, and the
+        other one on top, with an opacity of merge_ratio for the first layer.
+        present (list of boolean): for each layer, if it contains images
+        returns (list of (int, float)): the index of each layer to draw, in
+          order, with its opacity
+        """
+        shown = [i for i, v in enumerate(present) if v]
+        if len(shown) <= 1:
+            return [(i, 1.0) for i in shown]
+        
+        bbox1, bbox2 = [self.Layers[i].GetBoundingBox() for i in shown[0:2]]
+        ratio = self.merge_ratio
+        if bbox1[2] - bbox1[0] >= bbox2[2] - bbox2[0]:
+            return [(shown[0], 1.0), (shown[1], 1.0 - ratio)]
+        else:
+            return [(shown[1], 1.0), (shown[0], ratio)]
+    
+    def _ComputeTiles(self, request):
+        """
+        Computes the missing tiles of a request (called from the render thread)
+        request (RenderRequest)
+        returns (dict (int, int) -> (list, numpy array or None)): for each tile,
+          the drawn layers and the merged image
+        """
+        t_start = time.time()
+        
+        ts = request.tile_size
+        images = [ims for ims, opacity in request.layers]
+        opacities = [opacity for ims, opacity in request.layers]
+        tiles = {}
+        for (i, j) in request.missing:
+            layers = request.drawn.get((i, j))
+            if layers is None:
+                layers = [self._DrawLayer((i * ts, j * ts, ts, ts), request.scale, ims)
+                          for ims in images]
+            tiles[(i, j)] = (layers, self._BlendLayers(layers, opacities))
+        
+        request.duration = time.time() - t_start
+        self.metrics.count("tiles_computed", len(request.missing) - len(request.drawn))
+        self.metrics.count("tiles_reblended", len(request.drawn))
+        return tiles
+    
+    def _OnRenderDone(self, request, tiles):
+        """
+        Called in the GUI thread when the tiles of a request are computed
+        request (RenderRequest)
+        tiles (dict (int, int) -> (list, numpy array or None)): the computed
+          tiles (see _ComputeTiles()), or None if the computation failed (the
+          exception is in request.error)
+        """
+        if not self: # the window has been destroyed in the meantime
+            return
+        t_start = time.time()
+        
+        if tiles is None:
+            self.metrics.count("draws_failed")
+            # the tiles being computed might still be fine, only the ones on
+            # an area changed since the request are not
+            self._changed_areas = [(v, r) for v, r in self._changed_areas
+                                   if v > request.content_version]
+            if request.generation == self._render_generation:
+                # No other request is coming: the frames waiting for these
+                # changes will never be displayed
+                self._FailFrameFutures(request.changes, request.error)
+            return
+        
+        # Even if the request is outdated, the tiles might still be useful,
+        # excepted the ones on an area changed since the request
+        if request.state == self._tiles_state:
+            ts = request.tile_size
+            outdated = [self._GetTilesRange(rect, request.scale, ts)
+                        for v, rect in self._changed_areas
+                        if v > request.content_version]
+            # the merged tiles are only valid for the same opacities
+            merged_valid = request.opacities == self._tiles_opacities
+            with self.metrics.measure("bitmap"):
+                for k, (layers, merged) in tiles.items():
+                    if any(IsTileInRange(k, r) for r in outdated):
+                        continue
+                    self._tiles_layers[k] = layers
+                    if not merged_valid:
+                        continue
+                    if merged is None:
+                        self._tiles[k] = None
+                    else:
+                        self._tiles[k] = wx.BitmapFromBuffer(ts, ts, merged)
+        # the next requests are all more recent
+        self._changed_areas = [(v, r) for v, r in self._changed_areas
+                               if v > request.content_version]
+        
+        if request.generation != self._render_generation:
+            self._UpdateDrawDuration(request.duration + time.time() - t_start)
+            self.metrics.count("draws_superseded")
+            return # a newer request will update the buffer
+        
+        # The tiles not in the buffer anymore are dropped (and the outdated
+        # ones are missing, until the next request)
+        self._tiles = dict((k, self._tiles[k]) for k in request.needed
+                           if k in self._tiles)
+        self._tiles_layers = dict((k, self._tiles_layers[k]) for k in request.needed
+                                  if k in self._tiles_layers)
+        
+        # If just the position has changed, move the current content, and
+        # only draw the part newly exposed
+        shift = (request.center[0] - self._buffer_center[0],
+                 request.center[1] - self._buffer_center[1])
+        # (the images might have changed since the buffer was drawn, even if
+        # nothing changed after the request)
+        buffer_state = (request.state, request.opacities, request.content_version)
+        scrollable = (not self._needs_full_redraw and
+                      buffer_state == self._buffer_state and
+                      request.scale == self._buffer_scale and
+                      abs(shift[0]) < self.buffer_size[0] / 2 and
+                      abs(shift[1]) < self.buffer_size[1] / 2)
+        self._buffer_center = request.center
+        self._buffer_scale = request.scale
+        self._buffer_state = buffer_state
+        self._buffer_changes = request.changes
+        self._needs_full_redraw = False
+        if scrollable:
+            self._ScrollBuffer(shift)
+            self.metrics.count("draws_scrolled")
+        else:
+            self.Draw(self._dcBuffer)
+        self._UpdateDrawDuration(request.duration + time.time() - t_start)
+        self.metrics.count("draws")
     
         # eraseBackground doesn't seem to matter, but just in case...
         self.Refresh(eraseBackground=False) 
 #        self.Update() # not really necessary as refresh causes an onPaint event soon, but makes it slightly sooner, so smoother
 
-    def Draw(self, dc):
+    def _ScrollBuffer(self, shift):
+        """
+        Moves the content of the buffer and redraws the part newly exposed
+        shift (2-tuple int): how much the center of the buffer has moved (in px)
+        """
+        if shift == (0, 0):
+            return
+        size = self.buffer_size
+        # Copy to the back buffer (copying on itself would mix up the content
+        # on some platforms), and then swap them
+        dcBack = wx.MemoryDC()
+        dcBack.SelectObject(self._buffer_back)
+        with self.metrics.measure("blit"):
+            dcBack.BlitPointSize((max(0, -shift[0]), max(0, -shift[1])),
+                                 (size[0] - abs(shift[0]), size[1] - abs(shift[1])),
+                                 self._dcBuffer,
+                                 (max(0, shift[0]), max(0, shift[1])))
+        dcBack.SelectObject(wx.NullBitmap)
+        self._buffer, self._buffer_back = self._buffer_back, self._buffer
+        self._dcBuffer.SelectObject(self._buffer)
+        self._dcBuffer.SetBackground(wx.BLACK_BRUSH)
+        
+        # The exposed strips, on the side where the buffer moved
+        if shift[0] > 0:
+            self.Draw(self._dcBuffer, (size[0] - shift[0], 0, shift[0], size[1]))
+        elif shift[0] < 0:
+            self.Draw(self._dcBuffer, (0, 0, -shift[0], size[1]))
+        if shift[1] > 0:
+            self.Draw(self._dcBuffer, (0, size[1] - shift[1], size[0], shift[1]))
+        elif shift[1] < 0:
+            self.Draw(self._dcBuffer, (0, 0, size[0], -shift[1]))
+    
+    def Draw(self, dc, rect=None):
         """
-        Redraw the buffer with the images and overlays
+        Redraw the buffer with the images (as currently computed) and overlays
         dc (wx.DC)
+        rect (4-tuple int): the area of the buffer to redraw, or None for
+          everything
         overlays must have a Draw(dc, shift, scale) method
         """
 #        print "New bitmap drawing"
-        dc.Clear()
+        if rect is None:
+            dc.Clear()
+        else:
+            dc.SetClippingRegion(*rect)
+            # Clear() ignores the clipping region on some platforms
+            dc.SetPen(wx.TRANSPARENT_PEN)
+            dc.SetBrush(wx.BLACK_BRUSH)
+            dc.DrawRectangle(*rect)
         # set and reset the origin here because Blit in onPaint gets "confused" with values > 2048
         # centred on self.world_pos
         dc.SetDeviceOriginPoint((self.buffer_size[0] / 2, self.buffer_size[1] / 2))
@@ -298,14 +829,88 @@ class DraggableCanvas(wx.Panel):
         # to scaling computation twice when the image has a scale != 1. In 
         # addition, as coordinates are int, there is rounding error on zooming.
         
-        self._DrawMergedImages(dc, self.Images[0], self.Images[1], self.merge_ratio)
+        with self.metrics.measure("blit"):
+            self._DrawMergedImages(dc, rect)
 
-        # Each overlay draws itself
-        for o in self.Overlays:
-            o.Draw(dc, self.world_pos, self.scale)
+        # Each overlay draws itself, relative to the actual center of the
+        # buffer (aligned on the world pixels, like the images)
+        center_pos = (self._buffer_center[0] / self._buffer_scale,
+                      self._buffer_center[1] / self._buffer_scale)
+        with self.metrics.measure("overlays"):
+            for o in self.Overlays:
+                o.Draw(dc, center_pos, self._buffer_scale)
         
 #        dc.SetLogicalOriginPoint((0,0))
         dc.SetDeviceOriginPoint((0,0))
+        if rect is not None:
+            dc.DestroyClippingRegion()
+
+    def _GetUpdateRects(self):
+        """
+        returns (list of 4-tuple int): x, y, width, height of the areas of the
+          window to repaint
+        """
+        region = self.GetUpdateRegion()
+        rects = []
+        it = wx.RegionIterator(region)
+        while it.HaveRects():
+            rects.append((it.GetX(), it.GetY(), it.GetW(), it.GetH()))
+            it.Next()
+        if not rects: # repainted without update region => everything
+            return [(0, 0) + tuple(self.ClientSize)]
+        if len(rects) > MAX_PAINT_RECTS:
+            # too many small blits are slower than a big one
+            return [tuple(region.GetBox())]
+        return rects
+
+    def UpdateStaticOverlays(self):
+        """
+        To be called after the content of one of the static overlays has
+        changed (adding or removing an overlay is detected automatically)
+        """
+        self._static_overlays = None
+        self.Refresh(eraseBackground=False)
+
+    def _GetStaticOverlays(self):
+        """
+        Draws the static overlays on a bitmap of the size of the window, with
+        a mask where nothing is drawn. It's only redrawn when the overlays or
+        the size of the window change.
+        returns (wx.MemoryDC, 4-tuple int): the DC containing the bitmap, and
+          the area drawn (x, y, width, height). If nothing is drawn, the area
+          is None.
+        """
+        key = (tuple(self.StaticOverlays), tuple(self.ClientSize))
+        if self._static_overlays and self._static_overlays[0] == key:
+            return self._static_overlays[1:]
+        
+        self._dcStatic.SelectObject(wx.NullBitmap)
+        area = None
+        size = self.ClientSize
+        if self.StaticOverlays and size[0] > 0 and size[1] > 0:
+            bitmap = wx.EmptyBitmap(*size)
+            self._dcStatic.SelectObject(bitmap)
+            self._dcStatic.SetBackground(wx.Brush(STATIC_MASK_COLOUR))
+            self._dcStatic.Clear()
+            self.DrawStaticOverlays(self._dcStatic)
+            self._dcStatic.SetDeviceOrigin(0, 0)
+            self._dcStatic.SelectObject(wx.NullBitmap)
+            
+            # the bounding box of what has been drawn
+            # (keep the image as long as the array is used: it shares its memory)
+            im = bitmap.ConvertToImage()
+            a = GetImageArray(im)
+            drawn = (a != STATIC_MASK_COLOUR).any(axis=2)
+            rows = numpy.flatnonzero(drawn.any(axis=1))
+            cols = numpy.flatnonzero(drawn.any(axis=0))
+            if len(rows):
+                area = (int(cols[0]), int(rows[0]),
+                        int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1))
+                bitmap.SetMask(wx.Mask(bitmap, wx.Colour(*STATIC_MASK_COLOUR)))
+                self._dcStatic.SelectObject(bitmap)
+        
+        self._static_overlays = (key, self._dcStatic, area)
+        return self._dcStatic, area
 
     def DrawStaticOverlays(self, dc):
         """
@@ -317,68 +922,98 @@ class DraggableCanvas(wx.Panel):
         for o in self.StaticOverlays:
             o.Draw(dc)
 
-    # TODO change to a "ClipImageToBuffer" 
-    # TODO see if with Numpy it's faster (~less memory copy), cf http://wiki.wxpython.org/WorkingWithImages
-    # Could also see gdk_pixbuf_composite()
-    def _RescaleImageOptimized(self, dc, im, scale, center):
+    def _RescaleImageOptimized(self, rect, buffer_scale, im, scale, center):
         """
-        Rescale an image considering it will be displayed on the buffer
+        Rescale an image considering it will be displayed on the given area of
+        the world. Only the part of the image inside this area is computed.
         Does not modify the original image
+        rect (4-tuple int): area to display (in world pixels)
+        buffer_scale: the scale of the world pixels
         scale: the scale of the picture to fit the world
         center: position of the image in world coordinates
         return a tuple of
-           * a copy of the image rescaled, it can be of any size
-           * a 2-tuple representing the top-left point on the buffer coordinate
+           * a numpy array (h, w) or (h, w, 3) of the pixel values of the image
+             rescaled and cropped, or None if the image is completely outside
+             of the area
+           * a 2-tuple representing the top-left point in world pixels
         """
-        full_rect = self._GetImageRectOnBuffer(dc, im, scale, center)
-        total_scale = scale * self.scale
+        full_rect = self._GetImageRectOnWorld(im, scale, center, buffer_scale)
+        total_scale = scale * buffer_scale
+
+        # The part of the buffer actually covered by the image (left, top, right, bottom)
+        goal = (max(int(full_rect[0]), rect[0]),
+                max(int(full_rect[1]), rect[1]),
+                min(int(math.ceil(full_rect[0] + full_rect[2])), rect[0] + rect[2]),
+                min(int(math.ceil(full_rect[1] + full_rect[3])), rect[1] + rect[3]))
+        if goal[0] >= goal[2] or goal[1] >= goal[3]:
+            return (None, None) # no intersection
+
         if total_scale == 1.0:
-            ret = im.Copy() # TODO: should see how to avoid (it slows down quite a bit)
-            tl = full_rect[0:2]
-        elif total_scale < 1.0:
-            ret = im.Scale(*full_rect[2:4])
-            tl = full_rect[0:2]
-        elif total_scale > 1.0:
-            # We could end-up with a lot of the up-scaling useless, so crop it
-            orig_size = im.GetSize()
-            # where is the buffer in the world?
-            buffer_rect = (dc.DeviceToLogicalX(0),
-                           dc.DeviceToLogicalY(0),
-                           self.buffer_size[0],
-                           self.buffer_size[1])
-            goal_rect = wx.IntersectRect(full_rect, buffer_rect)
-            if not goal_rect: # no intersection
-                return (None, None)
-
-            # where is this rect in the original image?
-            unscaled_rect = ((goal_rect[0] - full_rect[0]) / total_scale,
-                             (goal_rect[1] - full_rect[1]) / total_scale,
-                             goal_rect[2] / total_scale,
-                             goal_rect[3] / total_scale)
-            # Note that width and length must be "double rounded" to account
-            # for the round down of the origin and round up of the bottom left
-            unscaled_rounded_rect = (int(unscaled_rect[0]), # rounding down
-                                     int(unscaled_rect[1]),
-                                     math.ceil(unscaled_rect[0] + unscaled_rect[2]) - int(unscaled_rect[0]),
-                                     math.ceil(unscaled_rect[1] + unscaled_rect[3]) - int(unscaled_rect[1]))
-            assert(unscaled_rounded_rect[0] + unscaled_rounded_rect[2] <= orig_size[0])
-            assert(unscaled_rounded_rect[1] + unscaled_rounded_rect[3] <= orig_size[1])
-            imcropped = im.GetSubImage(unscaled_rounded_rect)
-            
-            # like goal_rect but taking into account rounding
-            final_rect = ((unscaled_rounded_rect[0] * total_scale) + full_rect[0],
-                          (unscaled_rounded_rect[1] * total_scale) + full_rect[1],
-                          int(unscaled_rounded_rect[2] * total_scale),
-                          int(unscaled_rounded_rect[3] * total_scale))
-            ret = imcropped.Rescale(*final_rect[2:4])
-            # need to save it as the cropped part is not centred anymore
-            tl = final_rect[0:2]
-        return (ret, tl)
+            # the original pixels can be used directly (no copy)
+            orig, factor = self._GetImageLevel(im, 0)
+            ret = orig[goal[1] - int(full_rect[1]):goal[3] - int(full_rect[1]),
+                       goal[0] - int(full_rect[0]):goal[2] - int(full_rect[0])]
+            return (ret, goal[0:2])
+
+        # As long as the image is at the same scale and shows the same part,
+        # the result is the same, even if the buffer has moved.
+        key = (total_scale, goal[0] - full_rect[0], goal[1] - full_rect[1],
+               goal[2] - goal[0], goal[3] - goal[1])
+        ret = self.rescale_cache.get(im, key)
+        if ret is not None:
+            self.metrics.count("cache_hits")
+            return (ret, goal[0:2])
+        self.metrics.count("cache_misses")
+        t_start = time.time()
 
+        # When reducing, use the smallest version of the image which still has
+        # at least the resolution needed: the cost depends on the displayed
+        # size, and each pixel is the average of the original pixels.
+        if total_scale < 1.0:
+            level = int(math.floor(math.log(1.0 / total_scale, 2)))
+        else:
+            level = 0
+        orig, factor = self._GetImageLevel(im, level)
+        level_scale = total_scale * factor
+
+        # For each pixel of the goal, find the (nearest) pixel in the original
+        # image, taking the center of the pixel as reference
+        orig_size = orig.shape[1], orig.shape[0]
+        xs = numpy.arange(goal[0], goal[2]) + (0.5 - full_rect[0])
+        xs = (xs / level_scale).astype(numpy.intp).clip(0, orig_size[0] - 1)
+        ys = numpy.arange(goal[1], goal[3]) + (0.5 - full_rect[1])
+        ys = (ys / level_scale).astype(numpy.intp).clip(0, orig_size[1] - 1)
+
+        # Crop first (it's just a view), so that only the useful part is copied
+        cropped = orig[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1]
+        ret = cropped.take(ys - ys[0], axis=0).take(xs - xs[0], axis=1)
+        self.rescale_cache.put(im, key, ret)
+        self.metrics.add_time("rescale", time.time() - t_start)
+        return (ret, goal[0:2])
+
+    @staticmethod
+    def _GetImageLevel(im, level):
+        """
+        Gives the pixels of an image, reduced if possible
+        im (wx.Image or InstrumentalImage): the image. If it has a pyramid
+          (GetPyramidLevel()), the level requested is used, otherwise it is
+          the full image
+        level (0<=int): the image is reduced by 2^level (at most)
+        returns a tuple of:
+          * (numpy array (h, w) or (h, w, 3)): the pixel values of the image
+          * (int): the reduction factor actually used (2^level)
+        """
+        if hasattr(im, "GetPyramidLevel"):
+            level = min(level, im.GetPyramidMaxLevel())
+            return im.GetPyramidLevel(level), 2 ** level
+        else:
+            return GetImageArray(im), 1
 
-    def _GetImageRectOnBuffer(self, dc, im, scale, center):
+    @staticmethod
+    def _GetImageRectOnWorld(im, scale, center, buffer_scale):
         """
-        Computes the rectangle containing the image on the buffer coordinates
+        Computes the rectangle containing the image in world pixels (ie, world
+        coordinates at the scale of the buffer)
         return rect (4-tuple of floats)
         """
         # There are two scales:
@@ -389,80 +1024,140 @@ class DraggableCanvas(wx.Panel):
         actual_size = size[0] * scale, size[1] * scale
         tl_unscaled = (center[0] - (actual_size[0] / 2),
                        center[1] - (actual_size[1] / 2))
-        tl = self.WorldToBufferPoint(tl_unscaled)
-        final_size = (actual_size[0] * self.scale,
-                      actual_size[1] * self.scale)
+        tl = WorldToBufferPoint(tl_unscaled, (0, 0), buffer_scale)
+        final_size = (actual_size[0] * buffer_scale,
+                      actual_size[1] * buffer_scale)
         return tl + final_size
-        
-    @staticmethod
-    def memsetObject(bufferObject, value):
-        "Note, dangerous"
-        data = ctypes.POINTER(ctypes.c_char)()
-        size = ctypes.c_int()
-        ctypes.pythonapi.PyObject_AsCharBuffer(ctypes.py_object(bufferObject), ctypes.pointer(data), ctypes.pointer(size))
-        ctypes.memset(data, value, size.value)
-
-    def _DrawImageTransparentRescaled(self, dc, im, center, ratio=1.0, scale=1.0):
-        """
-        Draws one image with the given scale and opacity on the dc
-        dc wx.DC
-        im wx.Image
-        center (2-tuple float)
-        ratio (float)
-        scale (float)
-        """
-        if ratio <= 0.0:
-            return
-        
-        (imscaled, tl) = self._RescaleImageOptimized(dc, im, scale, center)
-        if not imscaled:
-            return
 
-        if ratio < 1.0:
-            # im2merged = im2scaled.AdjustChannels(1.0,1.0,1.0,ratio)
-            # TODO Check if we could speed up by caching the alphabuffer 
-            abuf = imscaled.GetAlphaBuffer()
-            self.memsetObject(abuf, int(255 * ratio))
+    def _DrawImage(self, drawn, rect, buffer_scale, im):
+        """
+        Draws one image (opaque) on an array
+        drawn (numpy array (h, w, 3) of uint8): the RGB array to draw on, it
+          represents the rect
+        rect (4-tuple int): area represented by drawn (in world pixels)
+        buffer_scale: the scale of the world pixels
+        im (wx.Image or InstrumentalImage): with its _dc_center and _dc_scale
+        returns (2-tuple of slices or None): the part of the array drawn, or
+          None if nothing was drawn
+        """
+        (imscaled, tl) = self._RescaleImageOptimized(rect, buffer_scale, im,
+                                                     im._dc_scale, im._dc_center)
+        if imscaled is None:
+            return None
+        imscaled = self._MapImage(im, imscaled)
 
-        dc.DrawBitmapPoint(wx.BitmapFromImage(imscaled), tl)
-    
-    def _DrawMergedImages(self, dc, im1, im2, ratio = 0.5):
+        area = (slice(tl[1] - rect[1], tl[1] - rect[1] + imscaled.shape[0]),
+                slice(tl[0] - rect[0], tl[0] - rect[0] + imscaled.shape[1]))
+        drawn[area] = imscaled
+        return area
+
+    def _MapImage(self, im, values):
+        """
+        Converts the pixel values of an image (as rescaled) to RGB intensities
+        im (wx.Image or InstrumentalImage): the image. If it has a look-up
+          table (GetLUT()), it is used.
+        values (numpy array (h, w) or (h, w, 3)): the pixel values
+        returns (numpy array (h, w, 3) of uint8): the intensities
+        """
+        if hasattr(im, "GetLUT"):
+            lut = im.GetLUT()
+            if lut is not None:
+                with self.metrics.measure("lut"):
+                    values = lut.take(values)
+        return GetRGBView(values)
+
+    def _DrawLayer(self, rect, buffer_scale, images):
+        """
+        Draws the images of a layer, on an area of the world. The images are
+        drawn centred around their _dc_center, with their own scale, in the
+        order given (the last one on top).
+        rect (4-tuple int): area to draw (in world pixels)
+        buffer_scale: the scale of the world pixels
+        images (list of images)
+        returns (None or 2-tuple): None if nothing is drawn in this area,
+          otherwise the drawn layer:
+          * (numpy array (h, w, 3) of uint8): the RGB pixels
+          * (numpy array (h, w) of bool or None): where the layer is drawn, or
+            None if it's drawn everywhere
         """
-        Draw the two images on the DC, centred around their _dc_center, with their own scale,
-        and an opacity of "ratio" for im1. They should be of the same size ratio.
-        Both _dc_center's should be close in order to have the parts with only
-        one picture drawn without transparency
-        dc: wx.DC
-        im1, im2 (wx.Image): the images
-        ratio (0<float<1): how much to merge the images
-        scale (0<float): the scaling of the images in addition to their own 
+        drawn = numpy.zeros((rect[3], rect[2], 3), dtype=numpy.uint8)
+        mask = numpy.zeros((rect[3], rect[2]), dtype=bool)
+        for im in images:
+            area = self._DrawImage(drawn, rect, buffer_scale, im)
+            if area is not None:
+                mask[area] = True
+        if not mask.any():
+            return None
+        if mask.all():
+            mask = None
+        return (drawn, mask)
+
+    def _BlendLayers(self, layers, opacities):
+        """
+        Merges drawn layers into one RGB array, each layer being drawn with
+        its opacity on top of the previous ones.
+        layers (list of drawn layers): see _DrawLayer()
+        opacities (list of float): the opacity of each layer
+        return (numpy array (h, w, 3) of uint8): the merged layers, or None if
+          nothing is drawn
         """
         t_start = time.time()
-        
-        if im1:
-            scale1 = im1._dc_scale
-        if im2:
-            scale2 = im2._dc_scale
-        
-        # There can be no image or just one image
-        if not im1:
-            if not im2:
-                return
-            self._DrawImageTransparentRescaled(dc, im2, im2._dc_center, scale=scale2)
-        elif not im2:
-            self._DrawImageTransparentRescaled(dc, im1, im1._dc_center, scale=scale1)
-        # The biggest picture should be drawn first, so that the outside is not
-        # mixed with the black background
-        elif (im1.GetWidth() * scale1 >= im2.GetWidth() * scale2):
-            self._DrawImageTransparentRescaled(dc, im1, im1._dc_center, scale=scale1)
-            self._DrawImageTransparentRescaled(dc, im2, im2._dc_center, 1.0 - ratio, scale2)
-        else:
-            self._DrawImageTransparentRescaled(dc, im2, im2._dc_center, scale=scale2)
-            self._DrawImageTransparentRescaled(dc, im1, im1._dc_center, ratio, scale1)
-        
-        t_now = time.time()
-        fps = 1.0 / float(t_now - t_start)
-        print "Display speed: " + str(fps) + " fps."
+        merged = None
+        for layer, opacity in zip(layers, opacities):
+            if layer is None or opacity <= 0.0:
+                continue
+            drawn, mask = layer
+            if merged is None:
+                merged = numpy.zeros(drawn.shape, dtype=numpy.uint8)
+            if opacity >= 1.0:
+                blended = drawn
+            else:
+                # integer computation is faster, and 16 bits are just enough:
+                # 255 * (255 - alpha) + 255 * alpha < 2**16
+                alpha = int(255 * opacity)
+                blended = merged.astype(numpy.uint16)
+                blended *= 255 - alpha
+                blended += drawn.astype(numpy.uint16) * alpha
+                blended //= 255
+            if mask is None:
+                merged[...] = blended
+            else:
+                numpy.copyto(merged, blended, casting="unsafe",
+                             where=mask[:, :, numpy.newaxis])
+        self.metrics.add_time("blend", time.time() - t_start)
+        return merged
+
+    def _GetBufferCenter(self):
+        """
+        returns (2-tuple int): the position where the center of the buffer
+          should be, in world pixels (world_pos aligned on the pixels)
+        """
+        return (int(round(self.world_pos[0] * self.scale)),
+                int(round(self.world_pos[1] * self.scale)))
+
+    def _DrawMergedImages(self, dc, rect=None):
+        """
+        Draw the merged images on the DC, as computed in the tiles (see
+        _DrawLayer() and _BlendLayers() for the way they are merged)
+        dc: wx.DC, with the origin at the center of the buffer
+        rect (4-tuple int): the area of the buffer to draw, or None for
+          everything
+        """
+        ts = self.tile_size
+        # position of the top-left of the buffer in world pixels
+        origin = (self._buffer_center[0] - self.buffer_size[0] / 2,
+                  self._buffer_center[1] - self.buffer_size[1] / 2)
+        for (i, j), bitmap in self._tiles.items():
+            if bitmap is None:
+                continue
+            # skip the tiles completely outside of the area
+            tl = (i * ts - origin[0], j * ts - origin[1]) # in the buffer
+            if (rect is not None and
+                (tl[0] >= rect[0] + rect[2] or tl[0] + ts <= rect[0] or
+                 tl[1] >= rect[1] + rect[3] or tl[1] + ts <= rect[1])):
+                continue
+            dc.DrawBitmapPoint(bitmap, (i * ts - self._buffer_center[0],
+                                        j * ts - self._buffer_center[1]))
     
     def WorldToBufferPoint(self, pos):
         """
@@ -482,4 +1177,176 @@ def WorldToBufferPoint(pos, world_pos, scale):
     return (round((pos[0] - world_pos[0]) * scale),
             round((pos[1] - world_pos[1]) * scale))
 
+def IntersectRect(a, b):
+    """
+    a, b (4-tuple int): x, y, width, height of two rectangles
+    returns (4-tuple int or None): the intersection of the rectangles, or None
+      if they don't intersect
+    """
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return (x0, y0, x1 - x0, y1 - y0)
+
+def IsTileInRange(tile, tiles):
+    """
+    tile (2-tuple int): index of a tile
+    tiles (4-tuple int): range of tiles, see DraggableCanvas._GetTilesRange()
+    returns (boolean): True if the tile is in the range
+    """
+    return (tiles[0] <= tile[0] <= tiles[2] and
+            tiles[1] <= tile[1] <= tiles[3])
+
+class RenderRequest(object):
+    """
+    A snapshot of everything needed to update the buffer of a canvas
+    """
+    def __init__(self, generation, changes, state, center, scale, layers,
+                 content_version, tile_size, needed, missing, drawn):
+        """
+        generation (int): number of the request, to detect outdated requests
+        changes (int): number of changes of the canvas taken into account
+        state (tuple): all the parameters which define the content of the tiles
+        center (2-tuple int): center of the buffer (in world pixels)
+        scale (float): scale of the buffer
+        layers (list of (list of images, float)): the images to draw, by
+          layer, with the opacity of the layer
+        content_version (int): the changes of the images taken into account
+        tile_size (int): size of the tiles (in px)
+        needed (list of 2-tuple int): all the tiles covering the buffer
+        missing (list of 2-tuple int): the tiles to compute
+        drawn (dict (int, int) -> list of drawn layers): for the missing tiles
+          whose layers are already drawn, the layers (to be just merged)
+        """
+        self.generation = generation
+        self.changes = changes
+        self.state = state
+        self.center = center
+        self.scale = scale
+        self.layers = layers
+        self.opacities = tuple(opacity for images, opacity in layers)
+        self.content_version = content_version
+        self.tile_size = tile_size
+        self.needed = needed
+        self.missing = missing
+        self.drawn = drawn
+        self.error = None # the exception, if the computation failed
+        self.duration = 0 # s, time it took to compute the tiles
+
+class FrameFuture(object):
+    """
+    Represents the display of a frame of a canvas which will happen later (see
+    DraggableCanvas.GetFrameFuture()).
+    """
+    def __init__(self, changes):
+        """
+        changes (int): number of changes of the canvas the frame must contain
+        """
+        self.changes = changes
+        self.start = time.time()
+        self.end = None # time when it was displayed
+        self.error = None # the exception, if the frame could not be rendered
+        self._callbacks = []
+        self._event = threading.Event()
+    
+    def done(self):
+        """
+        returns (boolean): True if the frame has been displayed (or failed to
+          be rendered, see .error)
+        """
+        return self._event.is_set()
+    
+    def result(self, timeout=None):
+        """
+        Waits for the frame to be displayed. It must not be called from the GUI
+        thread (which would then be blocked), instead, use a callback or
+        check done() while processing the events.
+        timeout (float): maximum time to wait (s), or None to wait forever
+        returns (float): latency between the creation of the future and the
+          display (s), or None if the frame is not displayed after the timeout
+        raises the exception which happened if the frame could not be rendered
+        """
+        self._event.wait(timeout)
+        if not self.done():
+            return None
+        if self.error is not None:
+            raise self.error
+        return self.end - self.start
+    
+    def add_done_callback(self, fn):
+        """
+        fn (callable): called with the future as argument, when the frame has
+          been displayed. If it is already displayed, it is called immediately.
+        """
+        if self.done():
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+    
+    def _resolve(self, error=None):
+        self.end = time.time()
+        self.error = error
+        self._event.set()
+        for fn in self._callbacks:
+            try:
+                fn(self)
+            except Exception:
+                traceback.print_exc()
+        self._callbacks = []
+
+class RenderThread(threading.Thread):
+    """
+    Thread which processes the render requests of a canvas, one at a time.
+    Only the latest request is processed: a request waiting is replaced by a
+    newer one.
+    """
+    def __init__(self, compute, callback):
+        """
+        compute (callable): takes a request and returns the result
+        callback (callable): takes the request and the result, it is called in
+          the GUI thread. If the computation failed, the result is None, and
+          the exception is in the .error of the request.
+        """
+        threading.Thread.__init__(self, name="Canvas renderer")
+        self.daemon = True
+        self._compute = compute
+        self._callback = callback
+        self._cond = threading.Condition()
+        self._request = None
+        self._stopped = False
+    
+    def Request(self, request):
+        """
+        Schedule a request to be processed
+        """
+        with self._cond:
+            self._request = request
+            self._cond.notify()
+    
+    def Stop(self):
+        """
+        Stops the thread (after the current request)
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+    
+    def run(self):
+        while True:
+            with self._cond:
+                while self._request is None and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                request, self._request = self._request, None
+            
+            try:
+                result = self._compute(request)
+            except Exception, e:
+                traceback.print_exc()
+                request.error = e
+                result = None
+            wx.CallAfter(self._callback, request, result)
+
 # vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
\ No newline at end of file
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 22 Feb 2012
+
+@author: Éric Piel
+
+Copyright © 2012 Éric Piel, Delmic
+
+This file is part of Delmic Acquisition Software.
+
+Delmic Acquisition Software is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version.
+
+Delmic Acquisition Software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
+'''
+import collections
+import threading
+
+class ImageCache(object):
+    """
+    A cache of (numpy) arrays limited by the memory they use. When the limit
+    is reached, the least recently used arrays are dropped.
+    Each entry is associated to the object the array has been computed from
+    (the "source"). The cache keeps a reference to this source as long as an
+    entry is present, so that its id cannot be reused by another object.
+    It can be used from several threads.
+    """
+    
+    def __init__(self, max_size=64 * 2**20):
+        """
+        max_size (int): maximum number of bytes used by all the arrays. It can
+          be changed later, and is taken into account at the next put().
+        """
+        self.max_size = max_size
+        self.size = 0 # bytes currently used
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict() # key -> (source, array)
+        self._lock = threading.Lock()
+    
+    def get(self, source, key):
+        """
+        Look for an entry in the cache
+        source (object): the object from which the array was computed
+        key (hashable): the other parameters used to compute the array
+        returns (numpy.ndarray): the array, or None if not in the cache
+        """
+        full_key = (id(source),) + key
+        with self._lock:
+            try:
+                entry = self._entries.pop(full_key)
+            except KeyError:
+                self.misses += 1
+                return None
+            
+            self._entries[full_key] = entry # put back as most recently used
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, source, key, array):
+        """
+        Add an entry to the cache (replacing the previous one with the same key)
+        source (object): the object from which the array was computed
+        key (hashable): the other parameters used to compute the array
+        array (numpy.ndarray): the result, it must not be modified afterwards
+        """
+        full_key = (id(source),) + key
+        with self._lock:
+            self._remove(full_key)
+            if array.nbytes > self.max_size:
+                return # would empty the whole cache for nothing
+            
+            self._entries[full_key] = (source, array)
+            self.size += array.nbytes
+            self._shrink()
+    
+    def forget(self, source):
+        """
+        Remove all the entries computed from a given source
+        source (object)
+        """
+        with self._lock:
+            for k, (s, a) in self._entries.items():
+                if s is source:
+                    self._remove(k)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+    
+    def _remove(self, full_key):
+        entry = self._entries.pop(full_key, None)
+        if entry is not None:
+            self.size -= entry[1].nbytes
+    
+    def _shrink(self):
+        """
+        Drop the least recently used entries until the cache fits in max_size
+        """
+        while self.size > self.max_size:
+            k, (s, a) = self._entries.popitem(last=False)
+            self.size -= a.nbytes
+        
+# vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 22 Feb 2012
+
+@author: Éric Piel
+
+Copyright © 2012 Éric Piel, Delmic
+
+This file is part of Delmic Acquisition Software.
+
+Delmic Acquisition Software is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version.
+
+Delmic Acquisition Software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
+'''
+from imagecache import ImageCache
+import numpy
+import unittest
+
+class Source(object):
+    pass
+
+class TestImageCache(unittest.TestCase):
+
+    def test_hit_miss(self):
+        cache = ImageCache(1000)
+        src = Source()
+        a = numpy.zeros((10, 10), dtype=numpy.uint8)
+        self.assertTrue(cache.get(src, (1.0,)) is None)
+        cache.put(src, (1.0,), a)
+        self.assertTrue(cache.get(src, (1.0,)) is a)
+        self.assertTrue(cache.get(src, (2.0,)) is None)
+        self.assertTrue(cache.get(Source(), (1.0,)) is None)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 3)
+        self.assertEqual(cache.size, 100)
+
+    def test_lru_eviction(self):
+        cache = ImageCache(250)
+        src = Source()
+        for i in range(3):
+            cache.put(src, (i,), numpy.zeros(100, dtype=numpy.uint8))
+        # too big => the oldest one must be dropped
+        self.assertTrue(cache.get(src, (0,)) is None)
+        self.assertEqual(cache.size, 200)
+        
+        # use 1 => 2 is now the oldest one
+        self.assertTrue(cache.get(src, (1,)) is not None)
+        cache.put(src, (3,), numpy.zeros(100, dtype=numpy.uint8))
+        self.assertTrue(cache.get(src, (2,)) is None)
+        self.assertTrue(cache.get(src, (1,)) is not None)
+        
+        # too big to fit at all => not kept, and the rest is kept
+        cache.put(src, (4,), numpy.zeros(1000, dtype=numpy.uint8))
+        self.assertTrue(cache.get(src, (4,)) is None)
+        self.assertEqual(cache.size, 200)
+
+    def test_forget(self):
+        cache = ImageCache(1000)
+        src1, src2 = Source(), Source()
+        cache.put(src1, (1,), numpy.zeros(100, dtype=numpy.uint8))
+        cache.put(src2, (1,), numpy.zeros(100, dtype=numpy.uint8))
+        cache.forget(src1)
+        self.assertTrue(cache.get(src1, (1,)) is None)
+        self.assertTrue(cache.get(src2, (1,)) is not None)
+        self.assertEqual(cache.size, 100)
+        
+if __name__ == "__main__":
+    unittest.main()
+    
+# vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
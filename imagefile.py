@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 1 Mar 2012
+
+@author: Éric Piel
+
+Copyright © 2012 Éric Piel, Delmic
+
+This file is part of Delmic Acquisition Software.
+
+Delmic Acquisition Software is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version.
+
+Delmic Acquisition Software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
+'''
+# Access to (very large) image files without loading them in memory: the
+# files are memory-mapped, and only the parts of the image actually used are
+# read from the disk. Only uncompressed files are supported.
+from imaging import DownsampleHalf
+import collections
+import numpy
+import os
+import struct
+import threading
+
+# TIFF tags used
+TIFF_WIDTH = 256
+TIFF_LENGTH = 257
+TIFF_BITS_PER_SAMPLE = 258
+TIFF_COMPRESSION = 259
+TIFF_PHOTOMETRIC = 262
+TIFF_STRIP_OFFSETS = 273
+TIFF_SAMPLES_PER_PIXEL = 277
+TIFF_ROWS_PER_STRIP = 278
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_PLANAR_CONFIG = 284
+TIFF_TILE_WIDTH = 322
+TIFF_TILE_LENGTH = 323
+TIFF_TILE_OFFSETS = 324
+
+# TIFF type -> struct format
+TIFF_TYPES = {1: "B", 3: "H", 4: "I"}
+
+def OpenImageFile(filename):
+    """
+    Opens an image file without reading it, if possible
+    filename (string)
+    returns (numpy array or BlockArray, or None): the image (h, w) or (h, w, 3),
+      read from the file only when accessed, or None if the file cannot be
+      memory-mapped (and must be loaded by other means)
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in (".tif", ".tiff"):
+        try:
+            return OpenTIFFFile(filename)
+        except ValueError:
+            return None # most likely compressed
+    return None
+
+def ReadImageSize(filename):
+    """
+    Reads the size of the image in a file, without reading the image
+    filename (string)
+    returns (2-tuple int, or None): width and height, or None if it cannot be
+      found quickly (only TIFF and PNG files are supported)
+    """
+    try:
+        with open(filename, "rb") as f:
+            header = f.read(24)
+            if header[0:8] == b"\x89PNG\r\n\x1a\n" and header[12:16] == b"IHDR":
+                return struct.unpack(">II", header[16:24])
+            if header[0:2] in (b"II", b"MM"):
+                endian = "<" if header[0:2] == b"II" else ">"
+                magic, ifd_offset = struct.unpack(endian + "HI", header[2:8])
+                if magic == 42:
+                    tags = _ReadTIFFTags(f, endian, ifd_offset)
+                    return tags[TIFF_WIDTH][0], tags[TIFF_LENGTH][0]
+    except (IOError, struct.error, KeyError):
+        pass
+    return None
+
+def OpenRawFile(filename, shape, dtype=numpy.uint8, offset=0):
+    """
+    Opens a file containing just the pixels of an image
+    filename (string)
+    shape (tuple of int): (height, width) or (height, width, 3)
+    dtype (numpy dtype): type of each value (with the byte order)
+    offset (int): position of the first pixel in the file (in bytes)
+    returns (numpy array): the image, read from the file only when accessed
+    """
+    return numpy.memmap(filename, dtype=dtype, mode="r", offset=offset,
+                        shape=shape)
+
+def OpenTIFFFile(filename):
+    """
+    Opens the (first) image of an uncompressed TIFF file
+    filename (string)
+    returns (numpy array or TiledArray): the image (h, w) or (h, w, 3), read
+      from the file only when accessed
+    raises ValueError: if the file is not a TIFF file that can be memory-mapped
+    """
+    with open(filename, "rb") as f:
+        header = f.read(8)
+        if header[0:2] == b"II":
+            endian = "<"
+        elif header[0:2] == b"MM":
+            endian = ">"
+        else:
+            raise ValueError("%s is not a TIFF file" % filename)
+        magic, ifd_offset = struct.unpack(endian + "HI", header[2:8])
+        if magic != 42:
+            raise ValueError("%s is not a (standard) TIFF file" % filename)
+        try:
+            tags = _ReadTIFFTags(f, endian, ifd_offset)
+        except struct.error:
+            raise ValueError("%s is not a valid TIFF file" % filename)
+
+    if TIFF_WIDTH not in tags or TIFF_LENGTH not in tags:
+        raise ValueError("%s has no image size" % filename)
+    width = tags[TIFF_WIDTH][0]
+    height = tags[TIFF_LENGTH][0]
+    spp = tags.get(TIFF_SAMPLES_PER_PIXEL, [1])[0]
+    bits = tags.get(TIFF_BITS_PER_SAMPLE, [1])
+    if tags.get(TIFF_COMPRESSION, [1])[0] != 1:
+        raise ValueError("Compressed TIFF files are not supported")
+    if tags.get(TIFF_PLANAR_CONFIG, [1])[0] != 1:
+        raise ValueError("Planar TIFF files are not supported")
+    if tags.get(TIFF_PHOTOMETRIC, [1])[0] not in (1, 2): # BlackIsZero, RGB
+        raise ValueError("Only greyscale and RGB TIFF files are supported")
+    if spp not in (1, 3) or bits[0] not in (8, 16) or len(set(bits)) != 1:
+        raise ValueError("Only 8 or 16 bits greyscale or RGB TIFF files are supported")
+    dtype = numpy.dtype(endian + "u%d" % (bits[0] // 8))
+    if spp == 1:
+        shape = (height, width)
+    else:
+        shape = (height, width, spp)
+
+    if TIFF_TILE_OFFSETS in tags:
+        if TIFF_TILE_WIDTH not in tags or TIFF_TILE_LENGTH not in tags:
+            raise ValueError("%s has no tile size" % filename)
+        tile_size = (tags[TIFF_TILE_LENGTH][0], tags[TIFF_TILE_WIDTH][0])
+        offsets = tags[TIFF_TILE_OFFSETS]
+    else:
+        # strips are like tiles of the width of the image
+        tile_size = (tags.get(TIFF_ROWS_PER_STRIP, [height])[0], width)
+        if TIFF_STRIP_OFFSETS not in tags or TIFF_STRIP_BYTE_COUNTS not in tags:
+            raise ValueError("%s has no image data" % filename)
+        offsets = tags[TIFF_STRIP_OFFSETS]
+        counts = tags[TIFF_STRIP_BYTE_COUNTS]
+        # Usually, the strips are one after another => just one array
+        contiguous = all(offsets[i] + counts[i] == offsets[i + 1]
+                         for i in range(len(offsets) - 1))
+        if contiguous:
+            return OpenRawFile(filename, shape, dtype, offsets[0])
+    return TiledArray(filename, shape, dtype, tile_size, offsets)
+
+def _ReadTIFFTags(f, endian, offset):
+    """
+    Reads the tags of an IFD
+    f (file)
+    endian (string): "<" or ">"
+    offset (int): position of the IFD
+    returns (dict int -> list of int): tag -> values (only for the integer tags)
+    """
+    f.seek(offset)
+    nentries = struct.unpack(endian + "H", f.read(2))[0]
+    entries = f.read(12 * nentries)
+    tags = {}
+    for i in range(nentries):
+        tag, ttype, count = struct.unpack(endian + "HHI", entries[i * 12:i * 12 + 8])
+        if ttype not in TIFF_TYPES:
+            continue
+        fmt = endian + TIFF_TYPES[ttype] * count
+        size = struct.calcsize(fmt)
+        if size <= 4: # the values are directly in the entry
+            data = entries[i * 12 + 8:i * 12 + 8 + size]
+        else:
+            pos = f.tell()
+            f.seek(struct.unpack(endian + "I", entries[i * 12 + 8:i * 12 + 12])[0])
+            data = f.read(size)
+            f.seek(pos)
+        tags[tag] = list(struct.unpack(fmt, data))
+    return tags
+
+class BlockArray(object):
+    """
+    A 2D (or RGB) image which is only partly available in memory: it is
+    accessed by blocks (tiles), which are computed only when needed. It can be
+    sliced like a numpy array (with slices only), and the result is a numpy
+    array. Subclasses must provide shape, dtype and tile_size, and _GetTile().
+    """
+    def _GetTile(self, i, j):
+        """
+        returns (numpy array): the tile at row i, column j. It might be smaller
+          than the tile size on the last row and column.
+        """
+        raise NotImplementedError()
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (2 - len(key))
+        if len(key) > 2 or not all(isinstance(k, slice) for k in key):
+            raise IndexError("Only slices of rows and columns are supported")
+        ranges = [k.indices(n) for k, n in zip(key, self.shape[:2])]
+        for start, stop, step in ranges:
+            if step <= 0:
+                raise IndexError("Only positive steps are supported")
+        outshape = tuple(len(range(*r)) for r in ranges) + self.shape[2:]
+        out = numpy.empty(outshape, dtype=self.dtype)
+        if 0 in outshape:
+            return out
+
+        (ystart, ystop, ystep), (xstart, xstop, xstep) = ranges
+        th, tw = self.tile_size
+        for i in range(ystart // th, (ystop - 1) // th + 1):
+            ys = _SliceInTile(ystart, ystop, ystep, i * th, (i + 1) * th)
+            if ys is None:
+                continue
+            for j in range(xstart // tw, (xstop - 1) // tw + 1):
+                xs = _SliceInTile(xstart, xstop, xstep, j * tw, (j + 1) * tw)
+                if xs is None:
+                    continue
+                tile = self._GetTile(i, j)
+                part = tile[ys[0]:ys[1]:ystep, xs[0]:xs[1]:xstep]
+                out[ys[2]:ys[2] + part.shape[0], xs[2]:xs[2] + part.shape[1]] = part
+        return out
+
+    def __array__(self, dtype=None):
+        a = self[:, :]
+        if dtype is not None:
+            a = a.astype(dtype)
+        return a
+
+class TiledArray(BlockArray):
+    """
+    An image stored by tiles (or strips) in a file. Only the tiles needed are
+    read.
+    """
+    def __init__(self, filename, shape, dtype, tile_size, offsets):
+        """
+        filename (string)
+        shape (tuple of int): (height, width) or (height, width, 3)
+        dtype (numpy dtype): type of each value (with the byte order)
+        tile_size (2-tuple int): height and width of each tile
+        offsets (list of int): position of each tile in the file, row by row
+        """
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.ndim = len(self.shape)
+        self.tile_size = tuple(tile_size)
+        self._offsets = offsets
+        self._file = numpy.memmap(filename, dtype=numpy.uint8, mode="r")
+        self._ntiles_x = (self.shape[1] + tile_size[1] - 1) // tile_size[1]
+
+    def _GetTile(self, i, j):
+        # It's just a view on the file, which is read only when accessed
+        th, tw = self.tile_size
+        pixel_size = self.dtype.itemsize * (self.shape[2] if self.ndim == 3 else 1)
+        start = self._offsets[i * self._ntiles_x + j]
+        data = self._file[start:start + th * tw * pixel_size]
+        # the last strip is usually shorter (but tiles are always complete)
+        h = min(th, self.shape[0] - i * th, data.size // (tw * pixel_size))
+        data = data[:h * tw * pixel_size].view(self.dtype)
+        return data.reshape((h, tw) + self.shape[2:])
+
+class ReducedArray(BlockArray):
+    """
+    An image reduced by 2 in each dimension (like DownsampleHalf()), computed
+    block by block, only when needed. The last blocks used are kept.
+    """
+    def __init__(self, source, tile_size=(256, 256), cache_size=64):
+        """
+        source (numpy array or BlockArray): the original image
+        tile_size (2-tuple int): height and width of each block
+        cache_size (int): number of blocks kept in memory
+        """
+        self.shape = (source.shape[0] // 2, source.shape[1] // 2) + source.shape[2:]
+        self.dtype = source.dtype
+        self.ndim = len(self.shape)
+        self.tile_size = tuple(tile_size)
+        self._source = source
+        self._cache = collections.OrderedDict() # (i, j) -> numpy array
+        self._cache_size = cache_size
+        self._cache_lock = threading.Lock()
+
+    def _GetTile(self, i, j):
+        with self._cache_lock:
+            tile = self._cache.pop((i, j), None)
+            if tile is not None:
+                self._cache[(i, j)] = tile # most recently used
+                return tile
+
+        th, tw = self.tile_size
+        part = self._source[i * th * 2:min((i + 1) * th, self.shape[0]) * 2,
+                            j * tw * 2:min((j + 1) * tw, self.shape[1]) * 2]
+        tile = DownsampleHalf(numpy.asarray(part))
+        with self._cache_lock:
+            self._cache[(i, j)] = tile
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return tile
+
+def IsLazy(a):
+    """
+    returns (boolean): True if the image a is not (entirely) in memory
+    """
+    return isinstance(a, (numpy.memmap, BlockArray))
+
+def _SliceInTile(start, stop, step, tstart, tstop):
+    """
+    Finds the part of a slice inside a tile
+    start, stop, step (int): the slice (positive step)
+    tstart, tstop (int): the range of the tile
+    returns (3-tuple int or None): start and stop in the tile, and the position
+      in the output of the first element, or None if the slice doesn't
+      contain any element of the tile
+    """
+    first = max(start, tstart)
+    first += (start - first) % step # next index in the slice
+    last = min(stop, tstop)
+    if first >= last:
+        return None
+    return (first - tstart, last - tstart, (first - start) // step)
+
+# vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
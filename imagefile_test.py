@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 1 Mar 2012
+
+@author: Éric Piel
+
+Copyright © 2012 Éric Piel, Delmic
+
+This file is part of Delmic Acquisition Software.
+
+Delmic Acquisition Software is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version.
+
+Delmic Acquisition Software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
+'''
+from imagefile import OpenImageFile, OpenRawFile, OpenTIFFFile, ReducedArray, \
+    TiledArray
+from imaging import DownsampleHalf
+import numpy
+import os
+import struct
+import tempfile
+import unittest
+
+def write_tiff(filename, a, endian="<", tile_size=None, rows_per_strip=None,
+               gap=0):
+    """
+    Writes a minimal uncompressed TIFF file
+    a (numpy array (h, w) or (h, w, 3) of uint8 or uint16): the image
+    tile_size (2-tuple int or None): if given, the image is stored by tiles
+    rows_per_strip (int or None): height of each strip (default is the whole
+      image)
+    gap (int): number of bytes between each strip or tile
+    """
+    h, w = a.shape[0:2]
+    a = a.astype(a.dtype.newbyteorder(endian))
+    spp = a.shape[2] if a.ndim == 3 else 1
+    if tile_size:
+        th, tw = tile_size
+        blocks = []
+        for y in range(0, h, th):
+            for x in range(0, w, tw):
+                # tiles are always complete (padded)
+                tile = numpy.zeros((th, tw) + a.shape[2:], dtype=a.dtype)
+                part = a[y:y + th, x:x + tw]
+                tile[:part.shape[0], :part.shape[1]] = part
+                blocks.append(tile.tostring())
+    else:
+        th = rows_per_strip or h
+        blocks = [a[y:y + th].tostring() for y in range(0, h, th)]
+
+    data = b""
+    offsets = []
+    for b in blocks:
+        offsets.append(8 + len(data))
+        data += b + b"\0" * gap
+    ifd_offset = 8 + len(data)
+    extra_offset = ifd_offset + 2 + 12 * 10 + 4
+    extra = b""
+
+    def entry(tag, ttype, values):
+        fmt = {3: "H", 4: "I"}[ttype] * len(values)
+        raw = struct.pack(endian + fmt, *values)
+        if len(raw) <= 4:
+            return struct.pack(endian + "HHI", tag, ttype, len(values)) + raw.ljust(4, b"\0")
+        pos = extra_offset + len(extra)
+        return struct.pack(endian + "HHII", tag, ttype, len(values), pos), raw
+
+    entries = [(256, 4, [w]), (257, 4, [h]), (258, 3, [a.dtype.itemsize * 8] * spp),
+               (259, 3, [1]), (262, 3, [1 if spp == 1 else 2]),
+               (277, 3, [spp])]
+    if tile_size:
+        entries += [(322, 4, [tw]), (323, 4, [th]), (324, 4, offsets),
+                    (325, 4, [len(b) for b in blocks])]
+    else:
+        entries += [(273, 4, offsets), (278, 4, [th]),
+                    (279, 4, [len(b) for b in blocks]), (284, 3, [1])]
+    ifd = struct.pack(endian + "H", len(entries))
+    for e in entries:
+        ret = entry(*e)
+        if isinstance(ret, tuple):
+            ifd += ret[0]
+            extra += ret[1]
+        else:
+            ifd += ret
+    ifd += struct.pack(endian + "I", 0)
+
+    header = (b"II" if endian == "<" else b"MM") + struct.pack(endian + "HI", 42, ifd_offset)
+    with open(filename, "wb") as f:
+        f.write(header + data + ifd + extra)
+
+class TestImageFile(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix=".tif")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def get_image(self, shape, dtype=numpy.uint8):
+        return (numpy.arange(numpy.prod(shape)) % 251).astype(dtype).reshape(shape)
+
+    def test_strips(self):
+        a = self.get_image((50, 30, 3))
+        write_tiff(self.filename, a, rows_per_strip=7)
+        im = OpenImageFile(self.filename)
+        # contiguous strips => just a memory-mapped array
+        self.assertTrue(isinstance(im, numpy.memmap))
+        numpy.testing.assert_array_equal(im, a)
+
+    def test_strips_gap(self):
+        a = self.get_image((50, 30), numpy.uint16) * 200
+        write_tiff(self.filename, a, endian=">", rows_per_strip=7, gap=3)
+        im = OpenTIFFFile(self.filename)
+        self.assertTrue(isinstance(im, TiledArray))
+        self.assertEqual(im.shape, a.shape)
+        numpy.testing.assert_array_equal(numpy.asarray(im), a)
+        numpy.testing.assert_array_equal(im[5:43:3, 2:27:4], a[5:43:3, 2:27:4])
+
+    def test_tiles(self):
+        a = self.get_image((70, 45, 3))
+        write_tiff(self.filename, a, tile_size=(16, 16))
+        im = OpenTIFFFile(self.filename)
+        self.assertTrue(isinstance(im, TiledArray))
+        self.assertEqual(im.shape, a.shape)
+        numpy.testing.assert_array_equal(im[:, :], a)
+        numpy.testing.assert_array_equal(im[15:17, 31:], a[15:17, 31:])
+        numpy.testing.assert_array_equal(im[1:70:2, 0:45:2], a[1:70:2, 0:45:2])
+        self.assertEqual(im[60:60, :].shape, (0, 45, 3))
+
+    def test_not_tiff(self):
+        with open(self.filename, "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n" + b"\0" * 100)
+        self.assertRaises(ValueError, OpenTIFFFile, self.filename)
+        self.assertTrue(OpenImageFile(self.filename) is None)
+
+    def test_raw(self):
+        a = self.get_image((20, 10), numpy.uint16)
+        with open(self.filename, "wb") as f:
+            f.write(b"\0" * 16 + a.tostring())
+        im = OpenRawFile(self.filename, a.shape, numpy.uint16, 16)
+        numpy.testing.assert_array_equal(im, a)
+
+    def test_reduced(self):
+        a = self.get_image((101, 67, 3))
+        write_tiff(self.filename, a, tile_size=(16, 32))
+        im = OpenTIFFFile(self.filename)
+        reduced = ReducedArray(im, tile_size=(8, 8), cache_size=4)
+        expected = DownsampleHalf(a)
+        self.assertEqual(reduced.shape, expected.shape)
+        numpy.testing.assert_array_equal(reduced[3:20, 10:30], expected[3:20, 10:30])
+        numpy.testing.assert_array_equal(numpy.asarray(reduced), expected)
+        self.assertTrue(len(reduced._cache) <= 4)
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
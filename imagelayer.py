@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 5 Mar 2012
+
+@author: Éric Piel
+
+Copyright © 2012 Éric Piel, Delmic
+
+This file is part of Delmic Acquisition Software.
+
+Delmic Acquisition Software is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version.
+
+Delmic Acquisition Software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
+'''
+import math
+
+class ImageLayer(object):
+    """
+    A set of images displayed together (ex: the fields of a mosaic), each at
+    its own position and scale (_dc_center and _dc_scale, in world units).
+    The images are stored in a grid (a spatial index), so that the ones in an
+    area are found without going through all the images.
+    Each image is identified by a key (any hashable).
+    """
+    def __init__(self, cell_size=None):
+        """
+        cell_size (float>0 or None): size of the cells of the grid (in world
+          units). If None, it is the size of the first image added, which is
+          good for a mosaic of images of the same size.
+        """
+        self.cell_size = cell_size
+        self.generation = 0 # increased at each change
+        self._images = {} # key -> (order, image, rect)
+        self._cells = {} # (int, int) -> set of keys
+        self._order = 0 # order of the next image added
+        self._bbox = None # cache of GetBoundingBox()
+
+    def __len__(self):
+        return len(self._images)
+
+    def __iter__(self):
+        """
+        Goes through the images in the order they were added
+        """
+        return iter([im for o, im, r in sorted(self._images.values())])
+
+    def __contains__(self, im):
+        return any(e[1] is im for e in self._images.values())
+
+    def Get(self, key):
+        """
+        returns (image or None): the image with the given key, if present
+        """
+        entry = self._images.get(key)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def Add(self, key, im):
+        """
+        Adds an image (replacing the image with the same key, if any). The
+        image must not be moved afterwards without adding it again.
+        key (hashable)
+        im (wx.Image or InstrumentalImage): with its _dc_center and _dc_scale
+        """
+        self.Remove(key)
+        rect = self.GetImageRect(im)
+        if self.cell_size is None:
+            self.cell_size = max(rect[2] - rect[0], rect[3] - rect[1]) or 1.0
+        self._images[key] = (self._order, im, rect)
+        self._order += 1
+        for c in self._GetCells(rect):
+            self._cells.setdefault(c, set()).add(key)
+        if self._bbox is not None:
+            self._bbox = (min(self._bbox[0], rect[0]), min(self._bbox[1], rect[1]),
+                          max(self._bbox[2], rect[2]), max(self._bbox[3], rect[3]))
+        self.generation += 1
+
+    def Remove(self, key):
+        """
+        Removes an image
+        key (hashable)
+        returns (image or None): the image removed, if it was present
+        """
+        entry = self._images.pop(key, None)
+        if entry is None:
+            return None
+        for c in self._GetCells(entry[2]):
+            keys = self._cells[c]
+            keys.discard(key)
+            if not keys:
+                del self._cells[c]
+        self._bbox = None
+        self.generation += 1
+        return entry[1]
+
+    def Query(self, rect):
+        """
+        Finds the images which intersect an area
+        rect (4-tuple float): left, top, right, bottom (in world units)
+        returns (list of images): in the order they were added
+        """
+        if not self._images:
+            return []
+        cs = self.cell_size
+        ncells = ((math.floor(rect[2] / cs) - math.floor(rect[0] / cs) + 1) *
+                  (math.floor(rect[3] / cs) - math.floor(rect[1] / cs) + 1))
+        if ncells > len(self._cells):
+            # big area (ex: very zoomed out) => faster to check every image
+            keys = self._images.keys()
+        else:
+            keys = set()
+            for c in self._GetCells(rect):
+                keys.update(self._cells.get(c, ()))
+        found = []
+        for k in keys:
+            order, im, r = self._images[k]
+            if (r[0] < rect[2] and rect[0] < r[2] and
+                r[1] < rect[3] and rect[1] < r[3]):
+                found.append((order, im))
+        found.sort()
+        return [im for o, im in found]
+
+    def GetBoundingBox(self):
+        """
+        returns (4-tuple float or None): left, top, right, bottom of the area
+          covered by all the images, or None if there is no image
+        """
+        if self._bbox is None and self._images:
+            rects = [r for o, im, r in self._images.values()]
+            self._bbox = (min(r[0] for r in rects), min(r[1] for r in rects),
+                          max(r[2] for r in rects), max(r[3] for r in rects))
+        return self._bbox
+
+    def _GetCells(self, rect):
+        """
+        returns (list of 2-tuple int): the cells of the grid touched by rect
+        """
+        cs = self.cell_size
+        if cs is None:
+            return []
+        return [(i, j)
+                for i in range(int(math.floor(rect[0] / cs)), int(math.floor(rect[2] / cs)) + 1)
+                for j in range(int(math.floor(rect[1] / cs)), int(math.floor(rect[3] / cs)) + 1)]
+
+    @staticmethod
+    def GetImageRect(im):
+        """
+        Computes the area covered by an image
+        im (wx.Image or InstrumentalImage): with its _dc_center and _dc_scale
+        returns (4-tuple float): left, top, right, bottom (in world units)
+        """
+        size = im.GetSize()
+        half = size[0] * im._dc_scale / 2.0, size[1] * im._dc_scale / 2.0
+        center = im._dc_center
+        return (center[0] - half[0], center[1] - half[1],
+                center[0] + half[0], center[1] + half[1])
+
+# vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
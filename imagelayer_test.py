@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 5 Mar 2012
+
+@author: Éric Piel
+
+Copyright © 2012 Éric Piel, Delmic
+
+This file is part of Delmic Acquisition Software.
+
+Delmic Acquisition Software is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version.
+
+Delmic Acquisition Software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
+'''
+from imagelayer import ImageLayer
+import unittest
+
+class Image(object):
+    def __init__(self, size, center, scale):
+        self.size = size
+        self._dc_center = center
+        self._dc_scale = scale
+
+    def GetSize(self):
+        return self.size
+
+class TestImageLayer(unittest.TestCase):
+
+    def test_Query(self):
+        layer = ImageLayer()
+        # a mosaic of 10x10 fields of 100x100 px, 1 px = 0.5 world unit
+        for i in range(10):
+            for j in range(10):
+                layer.Add((i, j), Image((100, 100), (i * 50 + 25, j * 50 + 25), 0.5))
+        self.assertEqual(len(layer), 100)
+        self.assertEqual(layer.cell_size, 50)
+        self.assertEqual(layer.GetBoundingBox(), (0, 0, 500, 500))
+
+        found = layer.Query((60, 10, 140, 40))
+        self.assertEqual(found, [layer.Get((1, 0)), layer.Get((2, 0))])
+        self.assertEqual(layer.Query((600, 600, 700, 700)), [])
+        # everything, in the order of addition
+        self.assertEqual(layer.Query((-1e6, -1e6, 1e6, 1e6)), list(layer))
+
+    def test_Change(self):
+        layer = ImageLayer(cell_size=10)
+        im1 = Image((10, 10), (5, 5), 1)
+        im2 = Image((100, 20), (50, 10), 1)
+        layer.Add("a", im1)
+        layer.Add("b", im2)
+        self.assertEqual(layer.Query((0, 0, 1, 1)), [im1, im2])
+        self.assertTrue(im1 in layer)
+        gen = layer.generation
+
+        # replace
+        im3 = Image((10, 10), (85, 5), 1)
+        layer.Add("a", im3)
+        self.assertTrue(layer.generation > gen)
+        self.assertFalse(im1 in layer)
+        self.assertEqual(layer.Query((0, 0, 1, 1)), [im2])
+        self.assertEqual(layer.Query((81, 1, 82, 2)), [im2, im3])
+
+        self.assertTrue(layer.Remove("b") is im2)
+        self.assertTrue(layer.Remove("b") is None)
+        self.assertEqual(layer.GetBoundingBox(), (80, 0, 90, 10))
+        self.assertEqual(layer.Query((0, 0, 100, 100)), [im3])
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 2 Mar 2012
+
+@author: Éric Piel
+
+Copyright © 2012 Éric Piel, Delmic
+
+This file is part of Delmic Acquisition Software.
+
+Delmic Acquisition Software is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version.
+
+Delmic Acquisition Software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
+'''
+# Loading of the image files in the background, so that the GUI is never
+# blocked while they are decoded.
+from imagefile import OpenImageFile, ReadImageSize
+from instrmodel import InstrumentalImage
+import Queue
+import multiprocessing
+import numpy
+import threading
+import traceback
+import wx
+
+# the placeholder is (at most) PLACEHOLDER_SIZE px wide
+PLACEHOLDER_SIZE = 64
+PLACEHOLDER_VALUE = 64 # dark grey
+
+def LoadImage(filename, mpp, center):
+    """
+    Reads an image file. Big uncompressed files are read only when displayed.
+    It can be called from any thread.
+    filename (string)
+    mpp (float>0)
+    center (2-tuple float)
+    returns (InstrumentalImage)
+    raises IOError: if the file cannot be read
+    """
+    data = OpenImageFile(filename)
+    if data is None:
+        if not wx.Image.CanRead(filename):
+            raise IOError("Cannot read image file %s" % filename)
+        data = wx.Image(filename)
+        if not data.IsOk():
+            raise IOError("Failed to decode image file %s" % filename)
+    return InstrumentalImage(data, mpp, center)
+
+def MakePlaceholder(filename, mpp, center):
+    """
+    Creates an image to display while the file is being loaded: a grey
+    rectangle, of the size of the image if it can be found quickly.
+    filename (string)
+    mpp (float>0)
+    center (2-tuple float)
+    returns (InstrumentalImage): the placeholder (empty if the size is unknown)
+    """
+    size = ReadImageSize(filename)
+    if size is None:
+        return InstrumentalImage(None, None, None)
+    # just a few pixels, covering the same area as the image
+    factor = max(1, -(-max(size) // PLACEHOLDER_SIZE)) # rounded up
+    data = numpy.empty((max(1, size[1] // factor), max(1, size[0] // factor)),
+                       dtype=numpy.uint8)
+    data.fill(PLACEHOLDER_VALUE)
+    return InstrumentalImage(data, mpp * factor, center)
+
+class LoadRequest(object):
+    """
+    The loading of one file, which can be cancelled
+    """
+    def __init__(self, filename, mpp, center, av, placeholder, callback=None):
+        self.filename = filename
+        self.mpp = mpp
+        self.center = center
+        self.av = av
+        self.placeholder = placeholder
+        self.callback = callback
+        self.cancelled = False
+        self.error = None # the exception, if the loading failed
+        self._done = threading.Event()
+
+    def Cancel(self):
+        """
+        The image will not be published (if it is not already)
+        """
+        self.cancelled = True
+        self._done.set()
+
+    def IsDone(self):
+        """
+        returns (boolean): True if the image is published, or will never be
+        """
+        return self._done.is_set()
+
+    def Wait(self, timeout=None):
+        """
+        Waits until the request is done
+        returns (boolean): True if the request is done
+        """
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+class ImageLoader(object):
+    """
+    Decodes image files in a pool of threads (one per core by default), and
+    publishes each image in its ActiveValue as soon as it is decoded. The
+    ActiveValues must accept being set from any thread (such as the images of
+    the SECOMModel).
+    """
+    def __init__(self, nthreads=None):
+        """
+        nthreads (int or None): number of threads, None for one per core
+        """
+        if nthreads is None:
+            nthreads = multiprocessing.cpu_count()
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock() # for _pending, and publishing
+        self._pending = {} # ActiveValue -> LoadRequest (the latest one)
+        for i in range(nthreads):
+            t = threading.Thread(target=self._run, name="Image loader %d" % i)
+            t.daemon = True
+            t.start()
+
+    def Load(self, filename, mpp, center, av, placeholder=True, callback=None):
+        """
+        Loads an image file in the background. If an image was still being
+        loaded for the same ActiveValue, it is cancelled.
+        filename (string)
+        mpp (float>0)
+        center (2-tuple float)
+        av (ActiveValue): will receive the InstrumentalImage
+        placeholder (boolean): if True, the ActiveValue immediately receives a
+          placeholder (see MakePlaceholder())
+        callback (callable or None): called with the LoadRequest, from the
+          loading thread, once the image is published or failed to be loaded
+          (see LoadRequest.error). It's not called if the request is cancelled.
+        returns (LoadRequest): to follow or cancel the loading
+        """
+        request = LoadRequest(filename, mpp, center, av, placeholder, callback)
+        if placeholder:
+            temp = MakePlaceholder(filename, mpp, center)
+        with self._lock:
+            prev = self._pending.get(av)
+            if prev:
+                prev.Cancel()
+            self._pending[av] = request
+            if placeholder:
+                av.value = temp
+        self._queue.put(request)
+        return request
+
+    def Cancel(self):
+        """
+        Cancels all the loadings not yet finished
+        """
+        with self._lock:
+            for request in self._pending.values():
+                request.Cancel()
+            self._pending.clear()
+
+    def _run(self):
+        while True:
+            request = self._queue.get()
+            if request.cancelled:
+                continue
+            try:
+                im = LoadImage(request.filename, request.mpp, request.center)
+            except Exception, e:
+                request.error = e
+                im = None
+
+            # publish with the lock, so that a cancelled image is never
+            # published after a newer one
+            with self._lock:
+                if request.cancelled:
+                    continue
+                if self._pending.get(request.av) is request:
+                    del self._pending[request.av]
+                if im is not None:
+                    request.av.value = im
+                elif request.placeholder: # don't leave it displayed
+                    request.av.value = InstrumentalImage(None, None, None)
+
+            if request.callback:
+                try:
+                    request.callback(request)
+                except Exception:
+                    traceback.print_exc()
+            request._done.set()
+
+# vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 2 Mar 2012
+
+@author: Éric Piel
+
+Copyright © 2012 Éric Piel, Delmic
+
+This file is part of Delmic Acquisition Software.
+
+Delmic Acquisition Software is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version.
+
+Delmic Acquisition Software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
+'''
+from imagefile_test import write_tiff
+from imageloader import ImageLoader, MakePlaceholder
+from instrmodel import InstrumentalImage
+from model import ThreadSafeActiveValue
+import numpy
+import os
+import shutil
+import tempfile
+import unittest
+
+class TestImageLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filenames = []
+        for i in range(6):
+            a = numpy.zeros((100 + i, 200), dtype=numpy.uint8)
+            a[:] = i
+            filename = os.path.join(self.dirname, "tile%d.tif" % i)
+            write_tiff(filename, a)
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_Placeholder(self):
+        im = MakePlaceholder(self.filenames[0], 0.001, (1, 2))
+        # same area, much less pixels
+        size = im.GetSize()
+        self.assertTrue(size[0] <= 64)
+        self.assertAlmostEqual(size[0] * im.mpp, 200 * 0.001)
+        self.assertEqual(im.center, (1, 2))
+
+        im = MakePlaceholder(os.path.join(self.dirname, "unknown.jpg"), 0.001, (1, 2))
+        self.assertTrue(im.image is None)
+
+    def test_Load(self):
+        loader = ImageLoader(nthreads=3)
+        avs = [ThreadSafeActiveValue(InstrumentalImage(None, None, None))
+               for f in self.filenames]
+        requests = [loader.Load(f, 0.001, (0, 0), av)
+                    for f, av in zip(self.filenames, avs)]
+        for i, (r, av) in enumerate(zip(requests, avs)):
+            self.assertTrue(r.Wait(5))
+            self.assertTrue(r.error is None)
+            self.assertEqual(av.value.GetSize(), (200, 100 + i))
+            self.assertEqual(av.value.GetPyramidLevel(0)[0, 0], i)
+
+    def test_Cancel(self):
+        loader = ImageLoader(nthreads=1)
+        av = ThreadSafeActiveValue(InstrumentalImage(None, None, None))
+        received = []
+        av.bind(lambda v: received.append(v))
+        # the same ActiveValue => the previous loadings are cancelled, and an
+        # older image is never published after a newer one
+        requests = [loader.Load(f, 0.001, (0, 0), av) for f in self.filenames]
+        self.assertTrue(requests[-1].Wait(5))
+        self.assertTrue(all(r.IsDone() for r in requests))
+        self.assertEqual(av.value.GetPyramidLevel(0)[0, 0], len(self.filenames) - 1)
+        loaded = [v.GetPyramidLevel(0)[0, 0] for v in received if v.mpp == 0.001]
+        self.assertEqual(loaded, sorted(set(loaded)))
+
+        # a failing file => the placeholder is removed, and it's reported
+        done = []
+        r = loader.Load(os.path.join(self.dirname, "unknown.tif"), 0.001, (0, 0), av,
+                        callback=done.append)
+        self.assertTrue(r.Wait(5))
+        self.assertTrue(r.error is not None)
+        self.assertTrue(av.value.image is None)
+        self.assertEqual(done, [r])
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 23 Feb 2012
+
+@author: Éric Piel
+
+Various functions to manipulate the data of images as numpy arrays.
+
+Copyright © 2012 Éric Piel, Delmic
+
+This file is part of Delmic Acquisition Software.
+
+Delmic Acquisition Software is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version.
+
+Delmic Acquisition Software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
+'''
+import numpy
+
+def GetImageArray(im):
+    """
+    Gives access to the RGB data of an image as a numpy array, without copy
+    im (wx.Image): the image
+    return (numpy array (h, w, 3) of uint8): the pixels, sharing the memory of the image
+    Warning: the array doesn't keep the image alive, so the image must be kept
+    (referenced) as long as the array is used, otherwise it reads freed memory.
+    """
+    size = im.GetSize()
+    return numpy.frombuffer(im.GetDataBuffer(), dtype=numpy.uint8).reshape((size[1], size[0], 3))
+
+def GetRGBView(a):
+    """
+    Gives an RGB version of a greyscale image, without copy
+    a (numpy array (h, w) or (h, w, 3)): the image
+    return (numpy array (h, w, 3)): the pixels, sharing the memory of a (the
+      same value is used for the 3 channels). If a is already RGB, it's a.
+    """
+    if a.ndim == 3:
+        return a
+    # a stride of 0 on the last dimension => the same value 3 times
+    return numpy.lib.stride_tricks.as_strided(a, shape=a.shape + (3,),
+                                              strides=a.strides + (0,))
+
+def ComputeHistogram(a, nbins):
+    """
+    Counts the pixels of each value
+    a (numpy array of uint8 or uint16): the image
+    nbins (int): number of possible values (ex: 256 for uint8)
+    return (numpy array of int): number of pixels for each value
+    """
+    return numpy.bincount(numpy.asarray(a).ravel(), minlength=nbins)[:nbins]
+
+def GetAutoRange(hist, outliers=0.001):
+    """
+    Finds the range of values which contains most of the pixels
+    hist (numpy array of int): the histogram (see ComputeHistogram())
+    outliers (0<=float<0.5): ratio of pixels ignored on each side
+    return (2-tuple int): the lowest and highest values of the range
+    """
+    cumul = numpy.cumsum(hist)
+    total = cumul[-1]
+    low = int(numpy.searchsorted(cumul, total * outliers, side="right"))
+    high = int(numpy.searchsorted(cumul, total * (1 - outliers)))
+    return min(low, high), max(low, high)
+
+def ComputeLUT(nbins, irange, brightness=0.0, contrast=1.0, gamma=1.0):
+    """
+    Computes the look-up table to convert the pixel values to 8 bits
+    nbins (int): number of possible values (ex: 65536 for uint16)
+    irange (2-tuple int): the values mapped to black and white
+    brightness (-1<=float<=1): added to the intensity (1 = white)
+    contrast (0<=float): factor applied to the intensity, around mid-grey
+    gamma (0<float): the intensity is raised to the power 1/gamma
+    return (numpy array of uint8 of size nbins): the 8-bit value for each value
+    """
+    low, high = irange
+    x = numpy.arange(nbins, dtype=numpy.float32)
+    x -= low
+    x /= max(high - low, 1)
+    if contrast != 1.0:
+        x -= 0.5
+        x *= contrast
+        x += 0.5
+    if brightness != 0.0:
+        x += brightness
+    x = x.clip(0, 1)
+    if gamma != 1.0:
+        x **= 1.0 / gamma
+    x *= 255
+    x += 0.5 # round
+    return x.astype(numpy.uint8)
+
+def DownsampleHalf(a):
+    """
+    Reduces an image by 2 in each dimension, each pixel being the average of 4
+    pixels of the original image. If a dimension is odd, the last row/column
+    is dropped.
+    a (numpy array (h, w, ...) of unsigned int): the image
+    return (numpy array (h/2, w/2, ...) of the same type): the reduced image
+    """
+    h, w = (a.shape[0] // 2) * 2, (a.shape[1] // 2) * 2
+    # the sum of 4 values needs 2 more bits
+    if a.dtype.itemsize == 1:
+        acc_type = numpy.uint16
+    else:
+        acc_type = numpy.uint32
+    # sum the 4 quarters one by one, to not need a (big) copy of the original
+    s = a[0:h:2, 0:w:2].astype(acc_type)
+    s += a[1:h:2, 0:w:2]
+    s += a[0:h:2, 1:w:2]
+    s += a[1:h:2, 1:w:2]
+    s //= 4
+    return s.astype(a.dtype)
+
+# vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
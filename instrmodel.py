@@ -16,7 +16,16 @@ Delmic Acquisition Software is distributed in the hope that it will be useful, b
 You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
 '''
 
-from model import ActiveValue
+from imagefile import IsLazy, ReducedArray
+from imaging import GetImageArray, ComputeHistogram, ComputeLUT, \
+    DownsampleHalf, GetAutoRange
+import collections
+import math
+from model import ActiveValue, ThreadSafeActiveValue, VersionedActiveValue
+import numpy
+import threading
+import time
+import traceback
 
 class SECOMModel(object):
     """
@@ -24,7 +33,18 @@ class SECOMModel(object):
     This is the main Model, from a Model/View/Controller perspective
     """
     
-    def __init__(self):
+    def __init__(self, stage=None):
+        """
+        stage: the actuator moving the sample, with MoveAbs(pos), GetPosition()
+          and IsMoving() (ex: SimulatedStage), or None if there is no stage
+        """
+        self.stage = stage
+        # The stage is moved in the background: stage_pos is the requested
+        # position, and stage_reported_pos where the stage actually is.
+        self.stage_reported_pos = ThreadSafeActiveValue((0,0)) # m,m
+        self.stage_scheduler = None
+        if stage is not None:
+            self.stage_scheduler = StageMoveScheduler(stage, self.stage_reported_pos)
         self.stage_pos = ActiveValue((0,0)) # m,m
         self.stage_pos.bind(self.avOnStagePos)
         
@@ -32,30 +52,361 @@ class SECOMModel(object):
         self.optical_emt_wavelength = ActiveValue(450) # nm XXX a range?
         self.optical_det_wavelength = ActiveValue(568) # nm
         self.optical_det_exposure_time = ActiveValue(0.5) # s
-        self.optical_det_image = ActiveValue(InstrumentalImage(None, None, None))
+        # the images can be set directly from the thread of the detector
+        self.optical_det_image = VersionedActiveValue(InstrumentalImage(None, None, None))
         
         self.sem_emt_dwell_time = ActiveValue(0.00001) #s
         self.sem_emt_spot = ActiveValue(4) # no unit (could be m²)
         self.sem_emt_hv = ActiveValue(30000) # V
-        self.sem_det_image = ActiveValue(InstrumentalImage(None, None, None))
+        self.sem_det_image = VersionedActiveValue(InstrumentalImage(None, None, None))
     
     def avOnStagePos(self, val):
-        print "requested to move stage to pos:", val 
+        if self.stage_scheduler:
+            self.stage_scheduler.MoveAbs(val)
+    
+    def Stop(self):
+        """
+        Stops the threads of the model (waiting for them to end)
+        """
+        if self.stage_scheduler:
+            self.stage_scheduler.Stop()
+            self.stage_scheduler = None
+
+class FrameRingBuffer(object):
+    """
+    Keeps the last frames received (ex: from a detector), so that the display
+    can always take the newest one. The frames received while the previous
+    one was being displayed are dropped (but kept in the history).
+    It can be used from several threads.
+    """
+    def __init__(self, length=10):
+        """
+        length (int): number of frames kept in the history
+        """
+        self._lock = threading.Lock()
+        self._frames = collections.deque(maxlen=length) # (number, time, frame)
+        self.received = 0 # number of frames received
+        self.displayed = 0 # number of frames taken by GetLatest()
+        self.dropped = 0 # number of frames never taken
+        self._last_taken = 0 # number of the last frame taken
+    
+    def Put(self, frame):
+        """
+        Adds a new frame
+        frame (object): the frame
+        returns (boolean): True if it's the only frame waiting to be taken (so
+          the display should be woken up)
+        """
+        with self._lock:
+            self.received += 1
+            self._frames.append((self.received, time.time(), frame))
+            return self.received == self._last_taken + 1
+    
+    def GetLatest(self):
+        """
+        Takes the newest frame, the older ones not yet taken are dropped
+        returns (object): the frame, or None if no new frame was received
+        """
+        with self._lock:
+            if self.received == self._last_taken:
+                return None
+            number, t, frame = self._frames[-1]
+            self.dropped += number - self._last_taken - 1
+            self.displayed += 1
+            self._last_taken = number
+            return frame
+    
+    def GetHistory(self):
+        """
+        returns (list of (int, float, object)): the last frames received, as
+          number, time of reception, and frame, from the oldest to the newest
+        """
+        with self._lock:
+            return list(self._frames)
+
+class StageMoveScheduler(object):
+    """
+    Sends the move requests to a stage, from a separate thread, without
+    flooding it: only the latest requested position is sent, and at most one
+    command per min_period. While the stage moves, its position is reported.
+    If the stage fails, the error is logged and kept in .error, and the next
+    requests are still sent.
+    """
+    def __init__(self, stage, reported_pos, min_period=0.1, poll_period=0.05):
+        """
+        stage: the actuator, with MoveAbs(pos), GetPosition() and IsMoving()
+        reported_pos (ActiveValue): updated with the position of the stage
+        min_period (float): minimum time between two commands (s)
+        poll_period (float): time between two reports of the position, while
+          moving (s)
+        """
+        self.stage = stage
+        self.reported_pos = reported_pos
+        self.min_period = min_period
+        self.poll_period = poll_period
+        self.requested_pos = None # latest position requested
+        self.commands = 0 # number of commands sent to the stage
+        self.error = None # exception of the last failed access to the stage
+        self.failures = 0 # number of failed accesses to the stage
+        
+        self._cond = threading.Condition()
+        self._target = None # position to send to the stage
+        self._last_command = 0 # time of the last command
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="Stage mover")
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def MoveAbs(self, pos):
+        """
+        Requests a move of the stage. It returns immediately. If the previous
+        request has not been sent yet, it is replaced.
+        pos (2-tuple float): the position (m, m)
+        """
+        with self._cond:
+            self.requested_pos = pos
+            self._target = pos
+            self._cond.notify()
+    
+    def Stop(self):
+        """
+        Stops the scheduler, and waits for its thread to end (the stage might
+        still be moving)
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                target = None
+                if (self._target is not None and
+                    time.time() >= self._last_command + self.min_period):
+                    target, self._target = self._target, None
+                    self._last_command = time.time()
+                    self.commands += 1
+            
+            try:
+                if target is not None:
+                    self.stage.MoveAbs(target)
+                moving = self.stage.IsMoving()
+                self.reported_pos.value = self.stage.GetPosition()
+            except Exception, e:
+                # keep going: the next request might work
+                traceback.print_exc()
+                self.error = e
+                self.failures += 1
+                moving = False
+            
+            with self._cond:
+                if self._stopped:
+                    return
+                if self._target is not None:
+                    timeout = self._last_command + self.min_period - time.time()
+                elif moving:
+                    timeout = self.poll_period
+                else:
+                    timeout = None # until the next request
+                if timeout is None or timeout > 0:
+                    self._cond.wait(timeout)
+
+class SimulatedStage(object):
+    """
+    Simulates a 2D stage: each move starts after some latency, and then goes
+    straight to the target at constant speed.
+    """
+    def __init__(self, speed=0.01, latency=0.05, pos=(0, 0)):
+        """
+        speed (float>0): m/s
+        latency (float>=0): time between a command and the start of the move (s)
+        pos (2-tuple float): initial position (m, m)
+        """
+        self.speed = speed
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._start_pos = tuple(pos)
+        self._target = tuple(pos)
+        self._start_time = 0
+    
+    def MoveAbs(self, pos):
+        """
+        Starts a move (the current move is interrupted)
+        pos (2-tuple float): the position to reach (m, m)
+        """
+        with self._lock:
+            now = time.time()
+            self._start_pos = self._GetPosition(now)
+            self._target = tuple(pos)
+            self._start_time = now
+    
+    def GetPosition(self):
+        """
+        returns (2-tuple float): the current position (m, m)
+        """
+        with self._lock:
+            return self._GetPosition(time.time())
+    
+    def IsMoving(self):
+        """
+        returns (boolean): True if the target is not reached yet
+        """
+        with self._lock:
+            return self._GetPosition(time.time()) != self._target
+    
+    def _GetPosition(self, t):
+        start, target = self._start_pos, self._target
+        distance = math.hypot(target[0] - start[0], target[1] - start[1])
+        moved = (t - self._start_time - self.latency) * self.speed
+        if moved <= 0:
+            return start
+        if moved >= distance:
+            return target
+        ratio = moved / distance
+        return (start[0] + (target[0] - start[0]) * ratio,
+                start[1] + (target[1] - start[1]) * ratio)
 
 class InstrumentalImage(object):
     """
     Contains a bitmap and meta data about it
+    It can also provide reduced versions of the bitmap (as a pyramid of
+    images, each level being half the size of the previous one), which are
+    computed only when needed.
+    The pixel values are converted to the displayed intensities by a look-up
+    table (see SetDisplayMapping()), which is applied after the rescaling.
     """
+    # number of pixels (at most) used to compute the histogram
+    HISTOGRAM_PIXELS = 2**18
+    # number of pixels above which the reduced versions of an image not in
+    # memory (see imagefile) are computed only by parts
+    LAZY_PIXELS = 2**22
     
-    def __init__(self, im, mpp, center):
+    def __init__(self, im, mpp, center, depth=None):
         """
-        im wx.Image
+        im (wx.Image or numpy array (h, w) or (h, w, 3) of uint8 or uint16):
+          the image, greyscale or RGB. The memory of the image is used directly
+          for display, so it should not be modified afterwards. It can also be
+          an image read from a file only when needed (see imagefile).
         mpp (float>0)
         center (2-tuple float)
+        depth (8<=int<=16): number of bits used in a uint16 array (default
+          is 16)
         """
+        if hasattr(im, "dtype"):
+            assert(im.dtype.kind == "u" and im.dtype.itemsize in (1, 2))
+            assert(im.ndim == 2 or (im.ndim == 3 and im.shape[2] == 3))
         self.image = im
         self.mpp = mpp
         self.center = center
+        self.depth = depth
+        self._pyramid = [] # numpy arrays (h, w) or (h, w, 3), index = level
+        # brightness, contrast, gamma, auto-stretch (see SetDisplayMapping())
+        self.mapping = (0.0, 1.0, 1.0, False)
+        self._lut = (None, None) # mapping, LUT
+        self._histogram = None
+    
+    def GetSize(self):
+        if hasattr(self.image, "dtype"):
+            return (self.image.shape[1], self.image.shape[0])
+        return self.image.GetSize()
+    
+    def GetPyramidMaxLevel(self):
+        """
+        returns (int): the last level available (the image is at least 1x1)
+        """
+        return int(math.log(min(self.GetSize()), 2))
+    
+    def GetPyramidLevel(self, level):
+        """
+        Gives a reduced version of the image
+        level (0<=int<=GetPyramidMaxLevel()): the image is reduced by 2^level.
+          Level 0 is the original image.
+        returns (numpy array (h, w) or (h, w, 3) of uint8 or uint16): the
+          pixel values at the given level (see GetLUT() to display them). It
+          must not be modified. For a big image not in memory, it is an object
+          which can only be sliced (which gives a numpy array).
+        """
+        assert(0 <= level <= self.GetPyramidMaxLevel())
+        if not self._pyramid:
+            if hasattr(self.image, "dtype"):
+                self._pyramid.append(self.image)
+            else:
+                self._pyramid.append(GetImageArray(self.image))
+        # each level is computed from the previous one (greyscale images are
+        # kept greyscale, so 3 times smaller)
+        while len(self._pyramid) <= level:
+            prev = self._pyramid[-1]
+            if IsLazy(prev) and prev.shape[0] * prev.shape[1] > self.LAZY_PIXELS:
+                # don't read the whole file now, only the parts displayed
+                self._pyramid.append(ReducedArray(prev))
+            else:
+                self._pyramid.append(DownsampleHalf(numpy.asarray(prev)))
+        return self._pyramid[level]
+    
+    def SetDisplayMapping(self, brightness=0.0, contrast=1.0, gamma=1.0, auto=False):
+        """
+        Changes how the pixel values are displayed. Only the look-up table is
+        recomputed, the rescaled images can be reused. The canvas displaying
+        the image must be updated afterwards.
+        brightness (-1<=float<=1): added to the intensity (1 = white)
+        contrast (0<=float): factor applied to the intensity, around mid-grey
+        gamma (0<float): the intensity is raised to the power 1/gamma
+        auto (boolean): if True, the range of intensities is stretched to the
+          range of the values present in the image (instead of all the
+          possible values)
+        """
+        self.mapping = (brightness, contrast, gamma, auto)
+    
+    def GetLUT(self):
+        """
+        returns (numpy array of uint8, or None): the 8-bit intensity for each
+          pixel value, or None if the values are already the intensities
+        """
+        mapping, lut = self._lut
+        if mapping == self.mapping:
+            return lut
+        
+        brightness, contrast, gamma, auto = self.mapping
+        nbins = self._GetNumberOfValues()
+        if auto:
+            irange = GetAutoRange(self.GetHistogram())
+        else:
+            irange = (0, nbins - 1)
+        if nbins == 256 and self.mapping == (0.0, 1.0, 1.0, False):
+            lut = None # identity
+        else:
+            # all the values of the type, in case some are above the depth
+            ntype = 2 ** (8 * self.GetPyramidLevel(0).dtype.itemsize)
+            lut = ComputeLUT(ntype, irange, brightness, contrast, gamma)
+        self._lut = (self.mapping, lut)
+        return lut
+    
+    def GetHistogram(self):
+        """
+        Computes the number of pixels of each value. It's computed only once,
+        from a reduced version of the image (with at most HISTOGRAM_PIXELS).
+        returns (numpy array of int): number of pixels for each value
+        """
+        if self._histogram is None:
+            size = self.GetSize()
+            level = 0
+            while (level < self.GetPyramidMaxLevel() and
+                   (size[0] >> level) * (size[1] >> level) > self.HISTOGRAM_PIXELS):
+                level += 1
+            self._histogram = ComputeHistogram(self.GetPyramidLevel(level),
+                                               self._GetNumberOfValues())
+        return self._histogram
+    
+    def _GetNumberOfValues(self):
+        """
+        returns (int): number of possible pixel values
+        """
+        if self.GetPyramidLevel(0).dtype == numpy.uint8:
+            return 256
+        return 2 ** (self.depth or 16)
         
 
 # vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
\ No newline at end of file
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 23 Feb 2012
+
+@author: Éric Piel
+
+Copyright © 2012 Éric Piel, Delmic
+
+This file is part of Delmic Acquisition Software.
+
+Delmic Acquisition Software is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version.
+
+Delmic Acquisition Software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
+'''
+from imagefile import OpenRawFile, ReducedArray
+from imaging import DownsampleHalf
+from instrmodel import InstrumentalImage, FrameRingBuffer, SECOMModel, \
+    SimulatedStage, StageMoveScheduler
+from model import ThreadSafeActiveValue
+import numpy
+import tempfile
+import time
+import unittest
+import wx
+
+class TestInstrumentalImage(unittest.TestCase):
+
+    def test_Pyramid(self):
+        im = wx.EmptyImage(11, 6, clear=True)
+        im.SetRGB(0, 0, 255, 0, 0) # top-left is red
+        im.SetRGB(1, 1, 255, 100, 0)
+        iim = InstrumentalImage(im, 0.001, (0, 0))
+        self.assertEqual(iim.GetPyramidMaxLevel(), 2)
+        
+        level0 = iim.GetPyramidLevel(0)
+        self.assertEqual(level0.shape, (6, 11, 3))
+        self.assertEqual(tuple(level0[1, 1]), (255, 100, 0))
+        
+        # each level is half the previous one, and pixels are averaged
+        level1 = iim.GetPyramidLevel(1)
+        self.assertEqual(level1.shape, (3, 5, 3))
+        self.assertEqual(tuple(level1[0, 0]), (127, 25, 0))
+        level2 = iim.GetPyramidLevel(2)
+        self.assertEqual(level2.shape, (1, 2, 3))
+        
+        # computed only once
+        self.assertTrue(iim.GetPyramidLevel(1) is level1)
+        
+    def test_Numpy(self):
+        # greyscale 8 bits => no copy
+        a = numpy.zeros((6, 11), dtype=numpy.uint8)
+        a[1, 1] = 200
+        iim = InstrumentalImage(a, 0.001, (0, 0))
+        self.assertEqual(iim.GetSize(), (11, 6))
+        level0 = iim.GetPyramidLevel(0)
+        self.assertTrue(level0 is a)
+        # the pyramid stays greyscale
+        self.assertEqual(iim.GetPyramidLevel(1).shape, (3, 5))
+        self.assertEqual(iim.GetPyramidLevel(1)[0, 0], 50)
+        
+        self.assertEqual(iim.GetLUT(), None) # displayed as is
+        
+        # RGB 16 bits (only 12 used) => converted to 8 bits by the LUT
+        a = numpy.zeros((6, 11, 3), dtype=numpy.uint16)
+        a[0, 0] = (4095, 2048, 0)
+        iim = InstrumentalImage(a, 0.001, (0, 0), depth=12)
+        self.assertTrue(iim.GetPyramidLevel(0) is a)
+        lut = iim.GetLUT()
+        self.assertEqual(lut.dtype, numpy.uint8)
+        self.assertEqual(tuple(lut[a[0, 0]]), (255, 128, 0))
+        self.assertEqual(lut[5000], 255) # above the depth
+
+    def test_Lazy(self):
+        # an image not in memory => the reduced versions are computed by parts
+        a = numpy.arange(64 * 48, dtype=numpy.uint16).reshape((64, 48))
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(a.tostring())
+            f.flush()
+            iim = InstrumentalImage(OpenRawFile(f.name, a.shape, numpy.uint16),
+                                    0.001, (0, 0))
+            iim.LAZY_PIXELS = 16 * 16
+            self.assertEqual(iim.GetSize(), (48, 64))
+            level1 = iim.GetPyramidLevel(1)
+            self.assertTrue(isinstance(level1, ReducedArray))
+            numpy.testing.assert_array_equal(level1[2:10, 3:5],
+                                             DownsampleHalf(a)[2:10, 3:5])
+            # small enough => in memory
+            self.assertTrue(isinstance(iim.GetPyramidLevel(3), numpy.ndarray))
+            self.assertEqual(iim.GetHistogram()[1000], 1)
+
+    def test_DisplayMapping(self):
+        a = numpy.zeros((64, 64), dtype=numpy.uint16)
+        a[:, :32] = 1000
+        a[:, 32:] = 2000
+        iim = InstrumentalImage(a, 0.001, (0, 0))
+        hist = iim.GetHistogram()
+        self.assertEqual(hist[1000], 64 * 32)
+        
+        iim.SetDisplayMapping(auto=True)
+        lut = iim.GetLUT()
+        self.assertEqual((lut[1000], lut[2000]), (0, 255))
+        self.assertTrue(iim.GetLUT() is lut) # cached
+        
+        # only the LUT is recomputed, not the histogram
+        iim.SetDisplayMapping(contrast=0.5, auto=True)
+        self.assertTrue(iim.GetHistogram() is hist)
+        lut = iim.GetLUT()
+        self.assertEqual((lut[1000], lut[2000]), (64, 191))
+        
+        iim.SetDisplayMapping(brightness=0.5, auto=True)
+        self.assertEqual(iim.GetLUT()[1000], 128)
+
+class TestFrameRingBuffer(unittest.TestCase):
+
+    def test_Drop(self):
+        frames = FrameRingBuffer(3)
+        self.assertEqual(frames.GetLatest(), None)
+        self.assertTrue(frames.Put("a")) # first one => wake up
+        self.assertFalse(frames.Put("b"))
+        self.assertEqual(frames.GetLatest(), "b")
+        self.assertEqual(frames.GetLatest(), None)
+        for f in "cdef":
+            frames.Put(f)
+        self.assertEqual(frames.GetLatest(), "f")
+        self.assertEqual((frames.received, frames.displayed, frames.dropped),
+                         (6, 2, 4))
+        # only the last ones are kept
+        self.assertEqual([f for n, t, f in frames.GetHistory()], ["d", "e", "f"])
+
+class TestStageMoveScheduler(unittest.TestCase):
+
+    def test_SimulatedStage(self):
+        stage = SimulatedStage(speed=0.01, latency=0.05)
+        stage.MoveAbs((0.001, 0))
+        self.assertEqual(stage.GetPosition(), (0, 0)) # latency
+        self.assertTrue(stage.IsMoving())
+        time.sleep(0.2)
+        self.assertEqual(stage.GetPosition(), (0.001, 0))
+        self.assertFalse(stage.IsMoving())
+
+    def test_Coalesce(self):
+        stage = SimulatedStage(speed=0.01, latency=0.01)
+        reported = ThreadSafeActiveValue((0, 0))
+        scheduler = StageMoveScheduler(stage, reported, min_period=0.1,
+                                       poll_period=0.01)
+        try:
+            # like a drag: many requests in a short time
+            for i in range(1, 101):
+                scheduler.MoveAbs((i * 1e-5, 0))
+                time.sleep(0.002)
+            self.assertEqual(scheduler.requested_pos, (100 * 1e-5, 0))
+            time.sleep(0.5)
+            # much less commands, but the final position is reached
+            self.assertTrue(scheduler.commands <= 5)
+            self.assertEqual(stage.GetPosition(), (100 * 1e-5, 0))
+            self.assertEqual(reported.value, (100 * 1e-5, 0))
+        finally:
+            scheduler.Stop()
+
+    def test_StageFailure(self):
+        stage = SimulatedStage(speed=0.01, latency=0.01)
+        reported = ThreadSafeActiveValue((0, 0))
+        scheduler = StageMoveScheduler(stage, reported, min_period=0.01,
+                                       poll_period=0.01)
+        move = stage.MoveAbs
+        def failing_move(pos):
+            raise IOError("stage controller error")
+        try:
+            stage.MoveAbs = failing_move
+            scheduler.MoveAbs((1e-5, 0))
+            time.sleep(0.2)
+            self.assertEqual(scheduler.failures, 1)
+            self.assertTrue(isinstance(scheduler.error, IOError))
+            
+            # the next requests are still sent
+            stage.MoveAbs = move
+            scheduler.MoveAbs((2e-5, 0))
+            time.sleep(0.2)
+            self.assertEqual(stage.GetPosition(), (2e-5, 0))
+            self.assertEqual(reported.value, (2e-5, 0))
+        finally:
+            scheduler.Stop()
+
+    def test_Model(self):
+        # no stage => the requests are just ignored
+        model = SECOMModel()
+        model.stage_pos.value = (0.001, 0)
+        self.assertEqual(model.stage_reported_pos.value, (0, 0))
+        model.Stop()
+        
+        model = SECOMModel(SimulatedStage(speed=0.01, latency=0.01))
+        try:
+            model.stage_pos.value = (0.001, 0)
+            time.sleep(0.5)
+            self.assertEqual(model.stage_reported_pos.value, (0.001, 0))
+        finally:
+            model.Stop()
+        self.assertTrue(model.stage_scheduler is None)
+
+if __name__ == "__main__":
+    unittest.main()
+    
+# vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
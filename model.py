@@ -15,34 +15,33 @@ Delmic Acquisition Software is distributed in the hope that it will be useful, b
 
 You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
 '''
+import collections
+import contextlib
+import threading
+import types
+import weakref
 
 class ActiveValue(object):
     '''
     An active value is a value (an object) that can let every one know when it 
     has been modified (actually modified, so putting the same value doesn't cause notification)
+    The listeners which are methods are referenced weakly: they don't keep
+    their object alive, and they are forgotten once the object is deleted.
+    The other listeners (functions...) are kept until unbound.
     '''
+    # There can be many ActiveValues, so keep them small
+    __slots__ = ("_value", "_listeners", "__weakref__")
 
     def __init__(self, initval):
         """
         Creates an active value with a given initial value
         initval : any type
         """
-        # TODO make it a weakref to automatically update the set when a listener
-        # goes away. See pypubsub weakmethod.py or http://mindtrove.info/python-weak-references/
-#        self._listeners = weakref.WeakSet()
-        self._listeners = set()
-        
-        # same as "self.value =  initval", but avoids __setattr__()
+        # key -> reference to the listener (see _make_ref()), or None if no
+        # listener (yet)
+        self._listeners = None
         self._set(initval)
         
-    def __dummy(self):
-        """
-        never call here,
-        just to make the code analysers happy by declaring the member explicitly
-        """
-        assert(False)
-        self.value = None
-        
     def bind(self, listener, init=False):
         """
         Register a callback function to be called when the ActiveValue is 
@@ -50,7 +49,9 @@ class ActiveValue(object):
         init (boolean): if True calls the listener directly, to initialise it
         """
         assert callable(listener)
-        self._listeners.add(listener)
+        if self._listeners is None:
+            self._listeners = {}
+        self._listeners[_get_key(listener)] = _make_ref(listener)
         
         if init:
             listener(self.value)
@@ -58,25 +59,352 @@ class ActiveValue(object):
         # TODO allow to pass custom additional parameters to the callback 
 
     def unbind(self, listener):
-        self._listeners.discard(listener)
+        if self._listeners:
+            self._listeners.pop(_get_key(listener), None)
 
     def notify(self):
-        for l in self._listeners:
-            l(self.value)
+        for l in self._get_listeners():
+            l(self._value)
+    
+    def _get_listeners(self):
+        """
+        returns (list of callable): the listeners still alive (the other ones
+          are removed)
+        """
+        if not self._listeners:
+            return []
+        listeners = []
+        for k, ref in self._listeners.items():
+            l = ref.get()
+            if l is None:
+                del self._listeners[k]
+            else:
+                listeners.append(l)
+        return listeners
     
     def _set(self, value):
         """
         Override to do checking on the value.
         """
-        object.__setattr__(self, "value", value)
+        self._value = value
     
-    def __setattr__(self, name, value):
-        if name == "value":
-            prev_value = self.value
-            self._set(value)
-            if prev_value != self.value:
+    def _has_changed(self, prev_value, value):
+        """
+        Override to change the way a modification is detected.
+        returns (boolean): True if the listeners should be notified
+        """
+        return prev_value != value
+    
+    def _get_value(self):
+        return self._value
+    
+    def _set_value(self, value):
+        prev_value = self._value
+        self._set(value)
+        if not self._listeners:
+            return # nobody to notify, no need to compare
+        if self._has_changed(prev_value, self._value):
+            if _batch_state.depth:
+                _batch_state.add(self, prev_value)
+            else:
                 self.notify()
+    
+    value = property(_get_value, _set_value,
+                     doc="The value, setting it notifies the listeners")
+
+class ThreadSafeActiveValue(ActiveValue):
+    """
+    An ActiveValue which can be modified from any thread (ex: the thread of a
+    detector driver). The listeners bound with gui=True are always called in
+    the GUI thread (via the wx event loop), and if the value changes faster
+    than they are called, only the latest value is passed. The other listeners
+    are called directly, in the thread which modified the value.
+    """
+    __slots__ = ("_lock",)
+    
+    def __init__(self, initval):
+        self._lock = threading.RLock()
+        ActiveValue.__init__(self, initval)
+    
+    def bind(self, listener, init=False, gui=False):
+        """
+        Register a callback function to be called when the ActiveValue is 
+        listener (function): callback function which takes as argument val the new value
+        init (boolean): if True calls the listener directly, to initialise it
+        gui (boolean): if True, the listener is always called in the GUI thread
+        """
+        assert callable(listener)
+        ref = _make_ref(listener)
+        if gui:
+            ref = _GUIListener(ref)
+        with self._lock:
+            if self._listeners is None:
+                self._listeners = {}
+            self._listeners[_get_key(listener)] = ref
+            value = self._value
+        
+        if init:
+            ref.get()(value)
+    
+    def unbind(self, listener):
+        with self._lock:
+            ActiveValue.unbind(self, listener)
+    
+    def notify(self):
+        with self._lock:
+            listeners = self._get_listeners()
+            value = self._value
+        for l in listeners:
+            l(value)
+    
+    def _get_listeners(self):
+        with self._lock:
+            return ActiveValue._get_listeners(self)
+    
+    def _set_value(self, value):
+        with self._lock:
+            prev_value = self._value
+            self._set(value)
+            if not self._has_changed(prev_value, self._value):
+                return
+            self._on_changed()
+            if not self._listeners:
+                return
+            listeners = self._get_listeners()
+            value = self._value
+        if _batch_state.depth:
+            _batch_state.add(self, prev_value)
         else:
-            object.__setattr__(self, name, value)
+            # the value as set by this thread, even if it has been modified
+            # again in the meantime
+            for l in listeners:
+                l(value)
+    
+    value = property(ActiveValue._get_value, _set_value,
+                     doc="The value, setting it notifies the listeners")
+    
+    def _on_changed(self):
+        """
+        Called (with the lock held) each time the value has changed
+        """
+        pass
+
+class VersionedActiveValue(ThreadSafeActiveValue):
+    """
+    A (thread-safe) ActiveValue which counts its modifications. It's adapted
+    to large values, such as images: by default, a modification is detected
+    only when a different object is set, without comparing the content.
+    The couple (id(value), generation) can be used as key in caches. 
+    """
+    __slots__ = ("generation", "_has_changed_hook")
+    
+    def __init__(self, initval, has_changed=None):
+        """
+        initval : any type
+        has_changed (callable): takes the previous and the new value, and
+          returns True if it is a modification. If None, any object which is
+          not the same as the previous one is a modification.
+        """
+        self.generation = 0 # increased at each modification
+        self._has_changed_hook = has_changed
+        ThreadSafeActiveValue.__init__(self, initval)
+    
+    def _has_changed(self, prev_value, value):
+        if self._has_changed_hook is None:
+            return prev_value is not value
+        return self._has_changed_hook(prev_value, value)
+    
+    def _on_changed(self):
+        self.generation += 1
+    
+    @property
+    def version(self):
+        """
+        (2-tuple int): identifies the current value, it changes at each
+          modification: id of the value, and generation
+        """
+        with self._lock:
+            return (id(self._value), self.generation)
+
+def _get_key(listener):
+    """
+    returns (hashable): identifies the listener (a bound method is created
+      each time it's accessed, so it's identified by its object and function)
+    """
+    obj = getattr(listener, "im_self", None)
+    if obj is not None:
+        return (id(obj), listener.im_func)
+    return listener
+
+def _make_ref(listener):
+    """
+    returns (object with a get() method): a reference to the listener, weak
+      if it's a method
+    """
+    if getattr(listener, "im_self", None) is not None:
+        return _WeakMethodRef(listener)
+    return _StrongRef(listener)
+
+class _WeakMethodRef(object):
+    """
+    Reference to a bound method, which doesn't keep its object alive
+    """
+    __slots__ = ("_obj", "_func")
+    
+    def __init__(self, method):
+        self._obj = weakref.ref(method.im_self)
+        self._func = method.im_func
+    
+    def get(self):
+        """
+        returns (callable): the method, or None if its object is deleted
+        """
+        obj = self._obj()
+        if obj is None:
+            return None
+        return types.MethodType(self._func, obj)
+
+class _StrongRef(object):
+    """
+    Reference to any callable, which keeps it alive
+    """
+    __slots__ = ("_listener",)
+    
+    def __init__(self, listener):
+        self._listener = listener
+    
+    def get(self):
+        return self._listener
+
+class _GUIListener(object):
+    """
+    Wraps (a reference to) a listener so that it is called in the GUI thread.
+    When called from another thread, the call is queued in the event loop, and
+    only the latest value is kept until then.
+    It is also its own reference (get()), alive as long as the listener is.
+    """
+    def __init__(self, ref):
+        self._ref = ref
+        self._lock = threading.Lock()
+        self._pending = False # a call is queued
+        self._value = None
+    
+    def get(self):
+        if self._ref.get() is None:
+            return None
+        return self
+    
+    def __call__(self, value):
+        if _is_gui_thread():
+            with self._lock:
+                self._pending = False # this value is newer than the queued one
+                self._value = None
+            self._call(value)
+            return
+        
+        with self._lock:
+            self._value = value
+            if self._pending:
+                return # the queued call will pass the new value
+            self._pending = True
+        _call_in_gui(self._deliver)
+    
+    def _deliver(self):
+        with self._lock:
+            if not self._pending:
+                return
+            value = self._value
+            self._pending = False
+            self._value = None
+        self._call(value)
+    
+    def _call(self, value):
+        listener = self._ref.get()
+        if listener is not None: # could have been deleted in the meantime
+            listener(value)
+
+# wx is imported only when needed, so that the model can be used without GUI
+def _is_gui_thread():
+    """
+    returns (boolean): True if the current thread is the GUI thread (or if
+      there is no GUI)
+    """
+    import wx
+    return wx.GetApp() is None or wx.Thread_IsMain()
+
+def _call_in_gui(f):
+    """
+    Calls a function in the GUI thread, as soon as possible
+    """
+    import wx
+    wx.CallAfter(f)
+
+class _BatchState(threading.local):
+    """
+    The notifications delayed by batch(), separately for each thread
+    """
+    def __init__(self):
+        self.depth = 0 # number of batch() currently entered
+        # ActiveValue -> value before the batch, in the order of modification
+        self.changed = collections.OrderedDict()
+    
+    def add(self, av, prev_value):
+        """
+        Records that an ActiveValue has been modified during the batch
+        av (ActiveValue)
+        prev_value: the value before the modification
+        """
+        if av not in self.changed:
+            self.changed[av] = prev_value
+
+_batch_state = _BatchState()
+
+@contextlib.contextmanager
+def batch():
+    """
+    Context manager to modify several ActiveValues at once: the listeners are
+    only notified at the end, and each listener is called at most once, with
+    the final value. A listener bound to several of the ActiveValues modified
+    is called with the value of the first one modified. An ActiveValue which
+    got back its original value doesn't notify. It applies only to the
+    ActiveValues modified in the current thread. The batches can be nested,
+    in which case the notifications happen at the end of the outermost one.
+    The ActiveValues modified by the listeners are in turn batched.
+    ex: with batch():
+          av1.value = 1
+          av2.value = 2
+    """
+    _batch_state.depth += 1
+    try:
+        yield
+    finally:
+        _batch_state.depth -= 1
+        if _batch_state.depth == 0:
+            _flush_batch()
+
+def _flush_batch():
+    """
+    Notifies the listeners of the ActiveValues modified during the batch. The
+    modifications done by the listeners are themselves batched, until nothing
+    changes anymore.
+    """
+    while _batch_state.changed:
+        changed = _batch_state.changed
+        _batch_state.changed = collections.OrderedDict()
+        # listener -> value, in the order of the first notification
+        calls = collections.OrderedDict()
+        for av, prev_value in changed.items():
+            if not av._has_changed(prev_value, av.value):
+                continue
+            for l in av._get_listeners():
+                if l not in calls:
+                    calls[l] = av.value
+        
+        _batch_state.depth += 1
+        try:
+            for l, value in calls.items():
+                l(value)
+        finally:
+            _batch_state.depth -= 1
             
 # vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
\ No newline at end of file
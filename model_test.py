@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 29 Feb 2012
+
+@author: Éric Piel
+
+Copyright © 2012 Éric Piel, Delmic
+
+This file is part of Delmic Acquisition Software.
+
+Delmic Acquisition Software is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version.
+
+Delmic Acquisition Software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
+'''
+from model import ActiveValue, ThreadSafeActiveValue, VersionedActiveValue, \
+    batch
+import model
+import numpy
+import threading
+import unittest
+
+class Listener(object):
+    def __init__(self):
+        self.values = []
+    
+    def callback(self, value):
+        self.values.append(value)
+
+class Uncomparable(object):
+    def __eq__(self, other):
+        raise ValueError("Cannot be compared")
+    __ne__ = __eq__
+
+class TestActiveValue(unittest.TestCase):
+
+    def test_Notify(self):
+        av = ActiveValue(0)
+        l = Listener()
+        av.bind(l.callback)
+        av.value = 1
+        av.value = 1 # same value => no notification
+        av.value = 2
+        self.assertEqual(l.values, [1, 2])
+        
+        av.unbind(l.callback)
+        av.value = 3
+        self.assertEqual(l.values, [1, 2])
+
+    def test_WeakListener(self):
+        av = ActiveValue(0)
+        l = Listener()
+        values = []
+        def callback(value):
+            values.append(value)
+        av.bind(l.callback)
+        av.bind(callback) # not a method => strong reference
+        av.value = 1
+        self.assertEqual(l.values, [1])
+        
+        # the listener doesn't keep its object alive
+        del l
+        av.value = 2
+        self.assertEqual(len(av._listeners), 1)
+        self.assertEqual(values, [1, 2])
+    
+    def test_Compact(self):
+        av = ActiveValue(0)
+        self.assertFalse(hasattr(av, "__dict__"))
+        self.assertRaises(AttributeError, setattr, av, "foo", 1)
+        # no listener => the values are not even compared
+        av.value = Uncomparable()
+        av.value = 1
+
+    def test_Batch(self):
+        av1 = ActiveValue(0)
+        av2 = ActiveValue(0)
+        l1, l2, lboth = Listener(), Listener(), Listener()
+        av1.bind(l1.callback)
+        av2.bind(l2.callback)
+        av1.bind(lboth.callback)
+        av2.bind(lboth.callback)
+        
+        with batch():
+            av1.value = 1
+            av1.value = 2
+            av2.value = 3
+            with batch(): # nested => still delayed
+                av2.value = 4
+            self.assertEqual(l1.values, [])
+            self.assertEqual(av1.value, 2)
+        
+        self.assertEqual(l1.values, [2])
+        self.assertEqual(l2.values, [4])
+        self.assertEqual(len(lboth.values), 1)
+        
+        # back to the original value => no notification
+        with batch():
+            av1.value = 5
+            av1.value = 2
+        self.assertEqual(l1.values, [2])
+        
+        # after the batch, notifications are immediate again
+        av1.value = 6
+        self.assertEqual(l1.values, [2, 6])
+
+    def test_BatchCascade(self):
+        # a listener which modifies other ActiveValues (like a view)
+        av1 = ActiveValue(0)
+        av2 = ActiveValue(0)
+        out1 = ActiveValue(0)
+        out2 = ActiveValue(0)
+        av1.bind(lambda v: setattr(out1, "value", v))
+        av2.bind(lambda v: setattr(out2, "value", v))
+        l = Listener()
+        out1.bind(l.callback)
+        out2.bind(l.callback)
+        
+        with batch():
+            av1.value = 1
+            av2.value = 2
+        self.assertEqual((out1.value, out2.value), (1, 2))
+        self.assertEqual(len(l.values), 1)
+
+    def test_BatchException(self):
+        av = ActiveValue(0)
+        l = Listener()
+        av.bind(l.callback)
+        try:
+            with batch():
+                av.value = 1
+                raise ValueError("test")
+        except ValueError:
+            pass
+        # the value was changed, so the listeners still know about it
+        self.assertEqual(l.values, [1])
+
+class TestVersionedActiveValue(unittest.TestCase):
+
+    def test_Generation(self):
+        a = numpy.zeros((100, 100))
+        av = VersionedActiveValue(a)
+        l = Listener()
+        av.bind(l.callback)
+        self.assertEqual(av.generation, 0)
+        self.assertEqual(av.version, (id(a), 0))
+        
+        av.value = a # same object => no change
+        self.assertEqual(l.values, [])
+        
+        # a different object, even with the same content, is a change
+        b = numpy.zeros((100, 100))
+        av.value = b
+        self.assertEqual(len(l.values), 1)
+        self.assertTrue(l.values[0] is b)
+        self.assertEqual(av.version, (id(b), 1))
+    
+    def test_Hook(self):
+        # only compare the shape
+        av = VersionedActiveValue(numpy.zeros((10, 10)),
+                                  lambda p, v: p.shape != v.shape)
+        l = Listener()
+        av.bind(l.callback)
+        av.value = numpy.ones((10, 10))
+        self.assertEqual((len(l.values), av.generation), (0, 0))
+        av.value = numpy.ones((20, 10))
+        self.assertEqual((len(l.values), av.generation), (1, 1))
+
+class TestThreadSafeActiveValue(unittest.TestCase):
+
+    def setUp(self):
+        # simulates the GUI thread and its event loop
+        self.queued = []
+        self.orig_dispatch = (model._is_gui_thread, model._call_in_gui)
+        model._is_gui_thread = lambda: threading.current_thread().name == "MainThread"
+        model._call_in_gui = self.queued.append
+    
+    def tearDown(self):
+        model._is_gui_thread, model._call_in_gui = self.orig_dispatch
+    
+    def run_events(self):
+        while self.queued:
+            self.queued.pop(0)()
+    
+    def test_Dispatch(self):
+        av = ThreadSafeActiveValue(0)
+        gui, direct = Listener(), Listener()
+        av.bind(gui.callback, gui=True)
+        av.bind(direct.callback)
+        
+        def acquire():
+            for i in range(1, 101):
+                av.value = i
+        t = threading.Thread(target=acquire)
+        t.start()
+        t.join()
+        
+        # direct listeners get every value, GUI ones only the latest
+        self.assertEqual(direct.values, range(1, 101))
+        self.assertEqual(gui.values, [])
+        self.assertEqual(len(self.queued), 1)
+        self.run_events()
+        self.assertEqual(gui.values, [100])
+        
+        # from the GUI thread, it's immediate
+        av.value = 0
+        self.assertEqual(gui.values, [100, 0])
+        
+        av.unbind(gui.callback)
+        av.value = 1
+        self.assertEqual(gui.values, [100, 0])
+
+    def test_GUISetOverridesQueued(self):
+        av = ThreadSafeActiveValue(0)
+        gui = Listener()
+        av.bind(gui.callback, gui=True)
+        t = threading.Thread(target=setattr, args=(av, "value", 1))
+        t.start()
+        t.join()
+        av.value = 2 # newer than the queued value
+        self.run_events()
+        self.assertEqual(gui.values, [2])
+
+if __name__ == "__main__":
+    unittest.main()
+    
+# vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
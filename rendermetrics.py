@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 27 Feb 2012
+
+@author: Éric Piel
+
+Copyright © 2012 Éric Piel, Delmic
+
+This file is part of Delmic Acquisition Software.
+
+Delmic Acquisition Software is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version.
+
+Delmic Acquisition Software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
+'''
+import contextlib
+import json
+import math
+import threading
+import time
+
+class TimeHistogram(object):
+    """
+    Distribution of durations, with buckets growing exponentially (each bucket
+    is twice as large as the previous one), from 1µs to about 1h.
+    """
+    NBUCKETS = 32
+    
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0 # s
+        self.min = None
+        self.max = None
+        self.buckets = [0] * self.NBUCKETS # bucket i contains [2^(i-1), 2^i[ µs
+    
+    def add(self, duration):
+        """
+        duration (float): in s
+        """
+        self.count += 1
+        self.total += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+        us = duration * 1e6
+        if us < 1:
+            i = 0
+        else:
+            i = min(int(math.log(us, 2)) + 1, self.NBUCKETS - 1)
+        self.buckets[i] += 1
+    
+    def percentile(self, p):
+        """
+        p (0<=float<=100): the percentile
+        returns (float): the (upper bound) duration below which p% of the
+          durations are, or None if no duration was recorded
+        """
+        if not self.count:
+            return None
+        goal = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= goal and n:
+                # the upper bound of the bucket, but no need to exaggerate
+                return min(2 ** i * 1e-6, self.max)
+        return self.max
+    
+    def get_stats(self):
+        """
+        returns (dict): summary of the distribution (durations in s)
+        """
+        if self.count:
+            mean = self.total / self.count
+        else:
+            mean = None
+        return {"count": self.count, "total": self.total, "mean": mean,
+                "min": self.min, "max": self.max,
+                "p50": self.percentile(50), "p90": self.percentile(90),
+                "p99": self.percentile(99)}
+
+class RenderMetrics(object):
+    """
+    Keeps track of the time spent in each stage of the rendering of a canvas,
+    and counts events. It can be used from several threads.
+    """
+    # the stages measured by the canvas
+    STAGES = ("rescale", "lut", "blend", "bitmap", "blit", "overlays", "paint")
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """
+        Forget all the measurements
+        """
+        with self._lock:
+            self._histograms = dict((s, TimeHistogram()) for s in self.STAGES)
+            self._counters = {}
+            self._start = time.time()
+    
+    def add_time(self, stage, duration):
+        """
+        Record the duration of a stage
+        stage (string)
+        duration (float): in s
+        """
+        with self._lock:
+            try:
+                h = self._histograms[stage]
+            except KeyError:
+                h = self._histograms[stage] = TimeHistogram()
+            h.add(duration)
+    
+    @contextlib.contextmanager
+    def measure(self, stage):
+        """
+        Context manager recording the time spent in the block
+        ex: with metrics.measure("paint"): ...
+        stage (string)
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - start)
+    
+    def count(self, name, n=1):
+        """
+        Increment a counter
+        name (string)
+        n (int): how much to add
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+    
+    def get_counter(self, name):
+        """
+        returns (int): the value of the counter (0 if never incremented)
+        """
+        with self._lock:
+            return self._counters.get(name, 0)
+    
+    def get_stats(self, stage):
+        """
+        returns (dict): count, total, mean, min, max, p50, p90, p99 of the
+          durations of the stage (in s)
+        """
+        with self._lock:
+            h = self._histograms.get(stage, TimeHistogram())
+            return h.get_stats()
+    
+    def get_all(self):
+        """
+        returns (dict): all the measurements: "stages" -> stage -> stats,
+          "counters" -> name -> int, "period" -> duration of the measurement (s)
+        """
+        with self._lock:
+            return {"stages": dict((s, h.get_stats()) for s, h in self._histograms.items()),
+                    "histograms": dict((s, list(h.buckets)) for s, h in self._histograms.items()),
+                    "counters": dict(self._counters),
+                    "period": time.time() - self._start}
+    
+    def dump(self, filename):
+        """
+        Writes all the measurements in a file (as JSON)
+        filename (string)
+        """
+        with open(filename, "w") as f:
+            json.dump(self.get_all(), f, indent=1, sort_keys=True)
+
+# vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell:
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 27 Feb 2012
+
+@author: Éric Piel
+
+Copyright © 2012 Éric Piel, Delmic
+
+This file is part of Delmic Acquisition Software.
+
+Delmic Acquisition Software is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version.
+
+Delmic Acquisition Software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Delmic Acquisition Software. If not, see http://www.gnu.org/licenses/.
+'''
+from rendermetrics import RenderMetrics
+import json
+import os
+import tempfile
+import unittest
+
+class TestRenderMetrics(unittest.TestCase):
+
+    def test_stats(self):
+        metrics = RenderMetrics()
+        for d in [0.001] * 90 + [0.1] * 10:
+            metrics.add_time("paint", d)
+        stats = metrics.get_stats("paint")
+        self.assertEqual(stats["count"], 100)
+        self.assertAlmostEqual(stats["mean"], 0.0109)
+        self.assertEqual(stats["min"], 0.001)
+        self.assertEqual(stats["max"], 0.1)
+        # percentiles are approximated by the buckets (x2 each)
+        self.assertTrue(0.001 <= stats["p50"] < 0.002)
+        self.assertTrue(0.001 <= stats["p90"] < 0.002)
+        self.assertEqual(stats["p99"], 0.1)
+        
+        self.assertEqual(metrics.get_stats("blit")["count"], 0)
+        
+    def test_counters(self):
+        metrics = RenderMetrics()
+        self.assertEqual(metrics.get_counter("draws"), 0)
+        metrics.count("draws")
+        metrics.count("draws", 2)
+        self.assertEqual(metrics.get_counter("draws"), 3)
+        metrics.reset()
+        self.assertEqual(metrics.get_counter("draws"), 0)
+    
+    def test_dump(self):
+        metrics = RenderMetrics()
+        with metrics.measure("rescale"):
+            pass
+        metrics.count("cache_hits")
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            metrics.dump(filename)
+            with open(filename) as f:
+                data = json.load(f)
+        finally:
+            os.remove(filename)
+        self.assertEqual(data["counters"]["cache_hits"], 1)
+        self.assertEqual(data["stages"]["rescale"]["count"], 1)
+        
+if __name__ == "__main__":
+    unittest.main()
+    
+# vim:tabstop=4:shiftwidth=4:expandtab:spelllang=en_gb:spell: